@@ -18,6 +18,12 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
+import asyncio
+import collections
+import concurrent.futures
+import math
+import queue
+import threading
 import time
 
 import Adafruit_GPIO as GPIO
@@ -79,12 +85,87 @@ LCD_PLATE_RED           = 6
 LCD_PLATE_GREEN         = 7
 LCD_PLATE_BLUE          = 8
 
+# MCP23017 registers of the char LCD plate (with IOCON.BANK = 0).
+MCP23017_IOCON          = 0x0A
+MCP23017_GPIOA          = 0x12
+MCP23017_IOCON_SEQOP    = 0x20
+# Largest SMBus block write, in bytes.
+I2C_BLOCK_SIZE          = 32
+
 # Char LCD plate button names.
 SELECT                  = 0
 RIGHT                   = 1
 DOWN                    = 2
 UP                      = 3
 LEFT                    = 4
+BUTTONS                 = (SELECT, RIGHT, DOWN, UP, LEFT)
+
+# Button events are 'press', 'release' or (while a button is held down)
+# 'repeat' events of a button, with the time of the event (from time.time()).
+ButtonEvent = collections.namedtuple('ButtonEvent', 'button kind time')
+
+# High resolution monotonic clock, falling back to time.time on old Pythons.
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+class TimingProfile(object):
+    """Timing requirements of a character LCD controller, in microseconds.
+    command_us is the time a command or character needs to execute before the
+    next one may be sent, clear_us the (much longer) time needed by clear and
+    home, and enable_pulse_us the minimum width of the enable pulse.
+    """
+
+    def __init__(self, name, command_us, clear_us, enable_pulse_us):
+        self.name = name
+        self.command_us = command_us
+        self.clear_us = clear_us
+        self.enable_pulse_us = enable_pulse_us
+
+
+# Conservative timing, as used by this library from the start.  Works with
+# every HD44780 compatible controller seen so far.
+HD44780_SAFE_TIMING     = TimingProfile('HD44780 safe', 1000, 3000, 1)
+# Timing from the HD44780 datasheet (37us per command, 1.52ms for clear and
+# home, at 270kHz) with a small margin.  Most displays and clones are fine
+# with this.
+HD44780_DATASHEET_TIMING = TimingProfile('HD44780 datasheet', 50, 2000, 1)
+
+
+class TimingEngine(object):
+    """Waits for LCD timing deadlines.  Waits shorter than the spin threshold
+    busy-wait on a high resolution monotonic clock, longer waits sleep for all
+    but the last spin_threshold_us microseconds so other threads can run.
+    Deadlines that have already passed, for example because the bus round-trip
+    of the previous write took longer than the command needs, cost nothing.
+    """
+
+    def __init__(self, spin_threshold_us=200):
+        self.spin_threshold = spin_threshold_us/1000000.0
+        self.waits = 0
+        self.skipped = 0
+        self.slept = 0
+
+    def now(self):
+        """Return the current time of the engine clock, in seconds."""
+        return _clock()
+
+    def wait_until(self, deadline):
+        """Wait until the engine clock reaches deadline (in seconds)."""
+        remaining = deadline - _clock()
+        if remaining <= 0:
+            self.skipped += 1
+            return
+        self.waits += 1
+        if remaining > self.spin_threshold:
+            self.slept += 1
+            time.sleep(remaining - self.spin_threshold)
+        while _clock() < deadline:
+            pass
+
+    def delay_microseconds(self, microseconds):
+        """Wait for the given number of microseconds from now."""
+        if microseconds > 0:
+            self.wait_until(_clock() + microseconds/1000000.0)
 
 class Adafruit_CharLCD(object):
     """Class to represent and interact with an HD44780 character LCD display."""
@@ -92,9 +173,11 @@ class Adafruit_CharLCD(object):
     def __init__(self, rs, en, d4, d5, d6, d7, cols, lines, backlight=None,
                     invert_polarity=True,
                     enable_pwm=False,
-                    gpio=GPIO.get_platform_gpio(),
-                    pwm=PWM.get_platform_pwm(),
-                    initial_backlight=1.0):
+                    gpio=None,
+                    pwm=None,
+                    initial_backlight=1.0,
+                    timing=HD44780_SAFE_TIMING,
+                    timing_engine=None):
         """Initialize the LCD.  RS, EN, and D4...D7 parameters should be the pins
         connected to the LCD RS, clock enable, and data line 4 through 7 connections.
         The LCD will be used in its 4-bit mode so these 6 lines are the only ones
@@ -121,7 +204,27 @@ class Adafruit_CharLCD(object):
         for example if you want to use an MCP230xx GPIO extender.  If you don't
         pass in an GPIO instance, the default GPIO for the running platform will
         be used.
+
+        The timing parameter is the TimingProfile of the display controller.
+        The default is the conservative HD44780_SAFE_TIMING; many displays work
+        fine with the much faster HD44780_DATASHEET_TIMING.  Delays are handled
+        by a TimingEngine, which you can pass in to change its spin threshold.
         """
+        # Look up the platform GPIO and PWM only when they are needed, so the
+        # module can be imported (and used with an explicit GPIO) anywhere.
+        if gpio is None:
+            gpio = GPIO.get_platform_gpio()
+        if pwm is None and enable_pwm:
+            pwm = PWM.get_platform_pwm()
+        # Save timing state.  Commands are not followed by a delay; instead the
+        # next write waits until the previous command has had time to execute.
+        self._timing = timing
+        self._timing_engine = timing_engine if timing_engine is not None else TimingEngine()
+        self._ready_at = 0
+        self._executor = None
+        # DDRAM address the cursor is at, so it can be restored after writing
+        # to CGRAM.
+        self._ddram_address = 0
         # Save column and line state.
         self._cols = cols
         self._lines = lines
@@ -148,9 +251,13 @@ class Adafruit_CharLCD(object):
             else:
                 gpio.setup(backlight, GPIO.OUT)
                 gpio.output(backlight, self._blpol if initial_backlight else not self._blpol)
-        # Initialize the display.
+        # Initialize the display.  The controller may be in any state after
+        # power-on, so the init sequence always uses the safe timing, whatever
+        # profile was passed in.
+        self._timing = HD44780_SAFE_TIMING
         self.write8(0x33)
         self.write8(0x32)
+        self._timing = timing
         # Initialize display control, function, and mode registers.
         self.displaycontrol = LCD_DISPLAYON | LCD_CURSOROFF | LCD_BLINKOFF
         self.displayfunction = LCD_4BITMODE | LCD_1LINE | LCD_2LINE | LCD_5x8DOTS
@@ -164,12 +271,14 @@ class Adafruit_CharLCD(object):
     def home(self):
         """Move the cursor back to its home (first line and first column)."""
         self.write8(LCD_RETURNHOME)  # set cursor position to zero
-        self._delay_microseconds(3000)  # this command takes a long time!
+        self._delay_next_write(self._timing.clear_us)  # this command takes a long time!
+        self._ddram_address = 0
 
     def clear(self):
         """Clear the LCD."""
         self.write8(LCD_CLEARDISPLAY)  # command to clear display
-        self._delay_microseconds(3000)  # 3000 microsecond sleep, clearing the display takes a long time
+        self._delay_next_write(self._timing.clear_us)  # clearing the display takes a long time
+        self._ddram_address = 0
 
     def set_cursor(self, col, row):
         """Move the cursor to an explicit column and row position."""
@@ -177,7 +286,8 @@ class Adafruit_CharLCD(object):
         if row > self._lines:
             row = self._lines - 1
         # Set location.
-        self.write8(LCD_SETDDRAMADDR | (col + LCD_ROW_OFFSETS[row]))
+        self._ddram_address = col + LCD_ROW_OFFSETS[row]
+        self.write8(LCD_SETDDRAMADDR | self._ddram_address)
 
     def enable_display(self, enable):
         """Enable or disable the display.  Set enable to True to enable."""
@@ -231,6 +341,18 @@ class Adafruit_CharLCD(object):
             self.displaymode &= ~LCD_ENTRYSHIFTINCREMENT
         self.write8(LCD_ENTRYMODESET | self.displaymode)
 
+    def executor(self):
+        """Return the single thread executor on which asyncio code runs the
+        blocking I/O of this display, so it never blocks the event loop and
+        never runs from two threads at once."""
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        return self._executor
+
+    def set_timing(self, timing):
+        """Set the TimingProfile of the display controller."""
+        self._timing = timing
+
     def message(self, text):
         """Write text to display.  Note that text can include newlines."""
         line = 0
@@ -245,6 +367,7 @@ class Adafruit_CharLCD(object):
             # Write the character to the display.
             else:
                 self.write8(ord(char), True)
+                self._advance_address(1)
 
     def set_backlight(self, backlight):
         """Enable or disable the backlight.  If PWM is not enabled (default), a
@@ -263,8 +386,9 @@ class Adafruit_CharLCD(object):
         value from 0-255, and char_mode is True if character data or False if
         non-character data (default).
         """
-        # One millisecond delay to prevent writing too quickly.
-        self._delay_microseconds(1000)
+        # Wait until the previous command has executed to prevent writing too
+        # quickly.
+        self._timing_engine.wait_until(self._ready_at)
         # Set character / data bit.
         self._gpio.output(self._rs, char_mode)
         # Write upper 4 bits.
@@ -279,6 +403,12 @@ class Adafruit_CharLCD(object):
                                  self._d6: ((value >> 2) & 1) > 0,
                                  self._d7: ((value >> 3) & 1) > 0 })
         self._pulse_enable()
+        self._delay_next_write(self._timing.command_us)
+
+    def write_bytes(self, values, char_mode=False):
+        """Write a sequence of 8-bit values in character or data mode."""
+        for value in values:
+            self.write8(value, char_mode)
 
     def create_char(self, location, pattern):
         """Fill one of the first 8 CGRAM locations with custom characters.
@@ -287,26 +417,62 @@ class Adafruit_CharLCD(object):
         design your custom character at http://www.quinapalus.com/hd44780udg.html
         To show your custom character use eg. lcd.message('\x01')
         """
+        self.create_chars({location: pattern})
+
+    def create_chars(self, patterns):
+        """Fill several CGRAM locations at once.  Patterns is a dict of location
+        (0 to 7) to pattern, see create_char.  Consecutive locations are written
+        with a single address command followed by one stream of data, as the
+        CGRAM address increments across location boundaries.  Afterwards the
+        cursor is moved back to where it was.
+        """
         # only position 0..7 are allowed
-        location &= 0x7
-        self.write8(LCD_SETCGRAMADDR | (location << 3))
-        for i in range(8):
-            self.write8(pattern[i], char_mode=True)
+        locations = sorted(set(location & 0x7 for location in patterns))
+        patterns = dict((location & 0x7, pattern) for location, pattern in patterns.items())
+        start = 0
+        while start < len(locations):
+            end = start + 1
+            while end < len(locations) and locations[end] == locations[end-1] + 1:
+                end += 1
+            self.write8(LCD_SETCGRAMADDR | (locations[start] << 3))
+            data = []
+            for location in locations[start:end]:
+                data.extend(patterns[location][i] for i in range(8))
+            self.write_bytes(data, True)
+            start = end
+        if locations:
+            self.write8(LCD_SETDDRAMADDR | self._ddram_address)
+
+    def _advance_address(self, count):
+        # Follow the DDRAM address after writing characters.  In 2-line mode
+        # the DDRAM holds two lines of 40 characters, at 0x00-0x27 and
+        # 0x40-0x67; the address counter runs from the end of one line to the
+        # start of the other.
+        if self.displaymode & LCD_ENTRYLEFT == 0:
+            count = -count
+        line, col = divmod(self._ddram_address, 0x40)
+        position = (line*40 + col + count) % 80
+        self._ddram_address = (position // 40)*0x40 + position % 40
 
     def _delay_microseconds(self, microseconds):
-        # Busy wait in loop because delays are generally very short (few microseconds).
-        end = time.time() + (microseconds/1000000.0)
-        while time.time() < end:
-            pass
+        # Short delays spin and long delays sleep, see TimingEngine.
+        self._timing_engine.delay_microseconds(microseconds)
+
+    def _delay_next_write(self, microseconds):
+        # Make sure the next write happens no sooner than the given number of
+        # microseconds from now.
+        self._ready_at = max(self._ready_at,
+                             self._timing_engine.now() + microseconds/1000000.0)
 
     def _pulse_enable(self):
         # Pulse the clock enable line off, on, off to send command.
+        pulse = self._timing.enable_pulse_us
         self._gpio.output(self._en, False)
-        self._delay_microseconds(1)       # 1 microsecond pause - enable pulse must be > 450ns
+        self._delay_microseconds(pulse)   # 1 microsecond pause - enable pulse must be > 450ns
         self._gpio.output(self._en, True)
-        self._delay_microseconds(1)       # 1 microsecond pause - enable pulse must be > 450ns
+        self._delay_microseconds(pulse)   # 1 microsecond pause - enable pulse must be > 450ns
         self._gpio.output(self._en, False)
-        self._delay_microseconds(1)       # commands need > 37us to settle
+        # Commands need > 37us to settle, which write8 takes care of.
 
     def _pwm_duty_cycle(self, intensity):
         # Convert intensity value of 0.0 to 1.0 to a duty cycle of 0.0 to 100.0
@@ -322,11 +488,13 @@ class Adafruit_RGBCharLCD(Adafruit_CharLCD):
     an RGB backlight."""
 
     def __init__(self, rs, en, d4, d5, d6, d7, cols, lines, red, green, blue,
-                 gpio=GPIO.get_platform_gpio(), 
+                 gpio=None,
                  invert_polarity=True,
                  enable_pwm=False,
-                 pwm=PWM.get_platform_pwm(),
-                 initial_color=(1.0, 1.0, 1.0)):
+                 pwm=None,
+                 initial_color=(1.0, 1.0, 1.0),
+                 timing=HD44780_SAFE_TIMING,
+                 timing_engine=None):
         """Initialize the LCD with RGB backlight.  RS, EN, and D4...D7 parameters 
         should be the pins connected to the LCD RS, clock enable, and data line 
         4 through 7 connections. The LCD will be used in its 4-bit mode so these 
@@ -348,6 +516,10 @@ class Adafruit_RGBCharLCD(Adafruit_CharLCD):
         pass in an GPIO instance, the default GPIO for the running platform will
         be used.
         """
+        if gpio is None:
+            gpio = GPIO.get_platform_gpio()
+        if pwm is None and enable_pwm:
+            pwm = PWM.get_platform_pwm()
         super(Adafruit_RGBCharLCD, self).__init__(rs, en, d4, d5, d6, d7,
                                                   cols,
                                                   lines, 
@@ -355,7 +527,9 @@ class Adafruit_RGBCharLCD(Adafruit_CharLCD):
                                                   backlight=None,
                                                   invert_polarity=invert_polarity,
                                                   gpio=gpio, 
-                                                  pwm=pwm)
+                                                  pwm=pwm,
+                                                  timing=timing,
+                                                  timing_engine=timing_engine)
         self._red = red
         self._green = green
         self._blue = blue
@@ -422,14 +596,43 @@ class Adafruit_CharLCDPlate(Adafruit_RGBCharLCD):
     """Class to represent and interact with an Adafruit Raspberry Pi character
     LCD plate."""
 
-    def __init__(self, address=0x20, busnum=I2C.get_default_bus(), cols=16, lines=2):
+    def __init__(self, address=0x20, busnum=None, cols=16, lines=2,
+                 timing=HD44780_SAFE_TIMING, timing_engine=None, i2c=None,
+                 bus_speed_khz=400):
         """Initialize the character LCD plate.  Can optionally specify a separate
         I2C address or bus number, but the defaults should suffice for most needs.
         Can also optionally specify the number of columns and lines on the LCD
-        (default is 16x2).
+        (default is 16x2), and the timing profile of the display.
+
+        Bytes are sent to the display as a stream of GPIOB port states in a few
+        I2C block writes.  Because no delays can be inserted in a block write,
+        the command timing is kept by repeating the idle port state, based on
+        the bus_speed_khz of the I2C bus.  Assuming a faster bus than the real
+        one only costs some extra bytes, so the default of 400 is safe on any
+        bus; on the 100kHz bus of a Raspberry Pi, bus_speed_khz=100 saves
+        bytes.
+
+        Note that batching only makes writes fast with a fast timing profile.
+        With the default HD44780_SAFE_TIMING, every byte is followed by a
+        millisecond of idle port states, which takes about as long as writing
+        bytes one by one.  Pass timing=HD44780_DATASHEET_TIMING to get the
+        speed-up, if the display supports it.
+
+        The i2c parameter can be used to pass in an alternative to the
+        Adafruit_GPIO.I2C module, for example a RecordingI2C instance.
         """
+        if busnum is None and i2c is None:
+            busnum = I2C.get_default_bus()
+        self._busnum = busnum
+        self._i2c = i2c
+        self._bus_byte_us = 9*1000.0/bus_speed_khz
         # Configure MCP23017 device.
-        self._mcp = MCP.MCP23017(address=address, busnum=busnum)
+        self._mcp = MCP.MCP23017(address=address, busnum=busnum, i2c=i2c)
+        # Disable sequential operation.  With IOCON.BANK = 0 the address pointer
+        # then toggles between the A and B register of a pair, so one block write
+        # to GPIOA can update GPIOB many times.  The two byte register accesses
+        # of Adafruit_GPIO work the same in this mode.
+        self._mcp._device.write8(MCP23017_IOCON, MCP23017_IOCON_SEQOP)
         # Set LCD R/W pin to low for writing only.
         self._mcp.setup(LCD_PLATE_RW, GPIO.OUT)
         self._mcp.output(LCD_PLATE_RW, GPIO.LOW)
@@ -441,10 +644,276 @@ class Adafruit_CharLCDPlate(Adafruit_RGBCharLCD):
         super(Adafruit_CharLCDPlate, self).__init__(LCD_PLATE_RS, LCD_PLATE_EN,
             LCD_PLATE_D4, LCD_PLATE_D5, LCD_PLATE_D6, LCD_PLATE_D7, cols, lines,
             LCD_PLATE_RED, LCD_PLATE_GREEN, LCD_PLATE_BLUE, enable_pwm=False, 
-            gpio=self._mcp)
+            gpio=self._mcp, timing=timing, timing_engine=timing_engine)
+
+    def bus_id(self):
+        """Return a value that is the same for all plates on the same I2C bus,
+        so a display manager can tell which displays can't be flushed at the
+        same time."""
+        return ('i2c', id(self._i2c) if self._i2c is not None else None, self._busnum)
 
     def is_pressed(self, button):
         """Return True if the provided button is pressed, False otherwise."""
         if button not in set((SELECT, RIGHT, DOWN, UP, LEFT)):
             raise ValueError('Unknown button, must be SELECT, RIGHT, DOWN, UP, or LEFT.')
         return self._mcp.input(button) == GPIO.LOW
+
+    def read_buttons(self):
+        """Return a dict of button to pressed state (True if pressed) for all
+        buttons, read from the GPIOA register in a single I2C transaction."""
+        port = self._mcp._device.readU8(MCP23017_GPIOA)
+        return dict((button, (port & (1 << button)) == 0) for button in BUTTONS)
+
+    async def buttons(self, poll_interval=0.02, **kwargs):
+        """Asynchronously iterate over button events, for example:
+
+            async for event in lcd.buttons():
+                if event.button == SELECT and event.kind == 'press':
+                    ...
+
+        The buttons are scanned every poll_interval seconds on the executor of
+        the display.  Other keyword arguments are passed to ButtonScanner to
+        set debounce and key repeat timing.
+        """
+        loop = asyncio.get_event_loop()
+        # The events are taken from what poll returns, so the scanner doesn't
+        # need to keep them in its queue.
+        scanner = ButtonScanner(self, queue_size=None, **kwargs)
+        while True:
+            events = await loop.run_in_executor(self.executor(), scanner.poll)
+            for event in events:
+                yield event
+            await asyncio.sleep(poll_interval)
+
+    def write8(self, value, char_mode=False):
+        """Write 8-bit value in character or data mode.  Value should be an int
+        value from 0-255, and char_mode is True if character data or False if
+        non-character data (default).
+        """
+        self.write_bytes([value], char_mode)
+
+    def message(self, text):
+        """Write text to display.  Note that text can include newlines.  Each
+        line is sent as a single batch of port states."""
+        for line, segment in enumerate(text.split('\n')):
+            if line > 0:
+                # Move to left or right side depending on text direction.
+                col = 0 if self.displaymode & LCD_ENTRYLEFT > 0 else self._cols-1
+                self.set_cursor(col, line)
+            self.write_bytes([ord(char) for char in segment], True)
+            self._advance_address(len(segment))
+
+    def write_bytes(self, values, char_mode=False):
+        """Write a sequence of 8-bit values in character or data mode, using as
+        few I2C block writes as possible.
+        """
+        if not values:
+            return
+        states = self._port_states(values, char_mode)
+        # Pair every GPIOB state with the unchanged GPIOA state, because the
+        # address pointer toggles between the two registers.
+        port_a = self._mcp.gpio[0]
+        data = []
+        for state in states:
+            data.append(port_a)
+            data.append(state)
+        self._timing_engine.wait_until(self._ready_at)
+        for i in range(0, len(data), I2C_BLOCK_SIZE):
+            self._mcp._device.writeList(MCP23017_GPIOA, data[i:i+I2C_BLOCK_SIZE])
+        # Keep the Adafruit_GPIO buffer in sync, so backlight changes don't
+        # undo the last state.
+        self._mcp.gpio[1] = states[-1]
+        self._delay_next_write(self._timing.command_us)
+
+    def _port_states(self, values, char_mode):
+        # Compute the sequence of GPIOB states that sends the values.  The first
+        # state sets RS with enable low, then every nibble is put on the data
+        # lines while raising enable, and latched by lowering enable again.
+        base = self._mcp.gpio[1] & ~_PLATE_PORTB_LCD_MASK
+        if char_mode:
+            base |= _PLATE_PORTB_RS
+        states = [base | _PLATE_NIBBLE_BITS[values[0] >> 4]]
+        # Repeat the idle state to wait for the command to execute, as each
+        # state takes two bytes on the bus.
+        byte_us = 8*self._bus_byte_us
+        padding = max(0, int(math.ceil((self._timing.command_us - byte_us)/(2*self._bus_byte_us))))
+        for value in values:
+            for nibble in ((value >> 4) & 0x0F, value & 0x0F):
+                state = base | _PLATE_NIBBLE_BITS[nibble]
+                states.append(state | _PLATE_PORTB_EN)
+                states.append(state)
+            states.extend([state]*padding)
+        return states
+
+
+# GPIOB bit masks of the char LCD plate.
+_PLATE_PORTB_RS = 1 << (LCD_PLATE_RS - 8)
+_PLATE_PORTB_EN = 1 << (LCD_PLATE_EN - 8)
+_PLATE_PORTB_DATA = [1 << (pin - 8) for pin in (LCD_PLATE_D4, LCD_PLATE_D5,
+                                                LCD_PLATE_D6, LCD_PLATE_D7)]
+_PLATE_PORTB_LCD_MASK = _PLATE_PORTB_RS | _PLATE_PORTB_EN | sum(_PLATE_PORTB_DATA)
+# GPIOB data bits for every nibble value (D4 is the least significant bit).
+_PLATE_NIBBLE_BITS = [sum(bit for n, bit in enumerate(_PLATE_PORTB_DATA) if nibble & (1 << n))
+                      for nibble in range(16)]
+
+
+class RecordingI2C(object):
+    """Stand-in for the Adafruit_GPIO.I2C module that talks to no hardware but
+    records every transaction, so bus traffic can be checked without a device.
+    Pass it as the i2c parameter of Adafruit_CharLCDPlate.  Transactions are
+    (busnum, address, operation, register, data) tuples.
+    """
+
+    def __init__(self):
+        self.transactions = []
+        self.devices = []
+
+    def get_i2c_device(self, address, busnum=None, **kwargs):
+        device = RecordingI2CDevice(self, address, busnum)
+        self.devices.append(device)
+        return device
+
+    def reset(self):
+        """Forget the recorded transactions."""
+        self.transactions = []
+
+    def bytes_transferred(self):
+        """Return the number of data bytes written and read, not counting the
+        address and register bytes of each transaction."""
+        return sum(len(transaction[4]) for transaction in self.transactions)
+
+
+class RecordingI2CDevice(object):
+    """I2C device of a RecordingI2C bus.  Reads return the values in the
+    inputs dict of register to value, or 0xFF (on the plate: no button
+    pressed) for registers that are not in it.
+    """
+
+    def __init__(self, bus, address, busnum):
+        self._bus = bus
+        self._address = address
+        self._busnum = busnum
+        self.inputs = {}
+
+    def _record(self, operation, register, data):
+        self._bus.transactions.append((self._busnum, self._address, operation, register, data))
+
+    def write8(self, register, value):
+        self._record('write', register, [value & 0xFF])
+
+    def writeList(self, register, data):
+        self._record('write', register, list(data))
+
+    def readU8(self, register):
+        value = self.inputs.get(register, 0xFF)
+        self._record('read', register, [value])
+        return value
+
+    def readList(self, register, length):
+        data = [self.inputs.get(register + i, 0xFF) for i in range(length)]
+        self._record('read', register, data)
+        return data
+
+
+class ButtonScanner(object):
+    """Scans the buttons of a char LCD plate with one I2C read per scan, and
+    turns the readings into debounced ButtonEvents.  A change of a button has
+    to be read for debounce seconds before it counts.  A button that is held
+    down repeats after repeat_delay seconds, every repeat_interval seconds
+    (set repeat_delay to None to disable key repeat).
+
+    Events are returned by poll(), and passed to callback if one is given.
+    Without a callback, they are also put in the events queue, which holds the
+    last queue_size events (older events are dropped when nobody reads them).
+    With queue_size None, or with a callback, events is None.  Call poll()
+    from your own loop, or start() to scan on a thread of the scanner.
+    """
+
+    def __init__(self, plate, debounce=0.02, repeat_delay=0.5,
+                 repeat_interval=0.1, callback=None, queue_size=64):
+        self._plate = plate
+        self.debounce = debounce
+        self.repeat_delay = repeat_delay
+        self.repeat_interval = repeat_interval
+        self.callback = callback
+        if callback is None and queue_size is not None:
+            self.events = queue.Queue(queue_size)
+        else:
+            self.events = None
+        self._pressed = dict((button, False) for button in BUTTONS)
+        self._reading = dict((button, False) for button in BUTTONS)
+        self._reading_since = dict((button, 0) for button in BUTTONS)
+        self._next_repeat = dict((button, None) for button in BUTTONS)
+        self._thread = None
+        self._stop = threading.Event()
+
+    def poll(self, now=None):
+        """Read the buttons once, and return the list of new events."""
+        reading = self._plate.read_buttons()
+        if now is None:
+            now = time.time()
+        events = []
+        for button in BUTTONS:
+            if reading[button] != self._reading[button]:
+                self._reading[button] = reading[button]
+                self._reading_since[button] = now
+            if self._reading[button] != self._pressed[button]:
+                if now - self._reading_since[button] >= self.debounce:
+                    self._pressed[button] = self._reading[button]
+                    if self._pressed[button]:
+                        events.append(ButtonEvent(button, 'press', now))
+                        if self.repeat_delay is not None:
+                            self._next_repeat[button] = now + self.repeat_delay
+                    else:
+                        events.append(ButtonEvent(button, 'release', now))
+                        self._next_repeat[button] = None
+            elif self._pressed[button] and self._next_repeat[button] is not None \
+                    and now >= self._next_repeat[button]:
+                events.append(ButtonEvent(button, 'repeat', now))
+                self._next_repeat[button] += self.repeat_interval
+                if self._next_repeat[button] < now:
+                    # Don't send a burst of repeats after a stall.
+                    self._next_repeat[button] = now + self.repeat_interval
+        for event in events:
+            if self.events is not None:
+                self._queue(event)
+            if self.callback is not None:
+                self.callback(event)
+        return events
+
+    def _queue(self, event):
+        # Make room by dropping the oldest event if the queue is full.
+        while True:
+            try:
+                self.events.put_nowait(event)
+                return
+            except queue.Full:
+                try:
+                    self.events.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def start(self, rate=100):
+        """Scan the buttons rate times per second on a thread of the scanner."""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(1.0/rate,),
+                                        name='ButtonScanner')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the scanning thread."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self, interval):
+        next_poll = time.time()
+        while not self._stop.is_set():
+            self.poll()
+            next_poll = max(next_poll + interval, time.time())
+            self._stop.wait(next_poll - time.time())
@@ -19,8 +19,18 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import os
 import time
 import re
+import json
+import math
+import runpy
+import array
+import bisect
+import asyncio
+import threading
+import concurrent.futures
+import collections
 import theme
 
 left = 0
@@ -28,14 +38,275 @@ right = 1
 center = 2
 scroll = False
 
+# Special characters are written as ~[NAME]. Messages are turned into glyph sequences once, when they are written to a
+# widget: a tuple with one integer per display cell. Ordinary characters are stored as their character code, special
+# characters as glyph_base plus the id of their name.
+glyph_base = 256
+space = ord(" ")
+unknown_glyph = 0xFFFF
+undefined_character = ord("?")
+special_character_pattern = re.compile(r"~\[(.*?)\]")
+
+class glyph_tokenizer(object):
+    """Turns messages into glyph sequences. Names of special characters are interned into a table of small integer ids,
+    and recently tokenized messages are kept in a least-recently-used cache of limited size, so writing the same string
+    again costs a single dictionary lookup.
+    The names of themes are always interned. Other names found in messages are interned up to max_names, so messages
+    with arbitrary ~[...] text (like song titles) can't fill the table; after that, new names get the glyph of
+    UNDEFINED."""
+    def __init__(self, symbols, cache_size=512, max_names=4096):
+        self.names = []
+        self.ids = {}
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.max_names = max_names
+        for name in sorted(symbols):
+            self.intern(name)
+        self.undefined = self.intern("UNDEFINED")
+
+    def intern(self, name):
+        """Returns the glyph of a special character name, adding the name to the table if it is new."""
+        if name not in self.ids:
+            self.ids[name] = glyph_base + len(self.names)
+            self.names.append(name)
+        return self.ids[name]
+
+    def lookup(self, name):
+        """Returns the glyph of a special character name found in a message. New names are interned as long as the
+        table has room."""
+        if name in self.ids:
+            return self.ids[name]
+        if len(self.names) >= self.max_names:
+            return self.undefined
+        return self.intern(name)
+
+    def name(self, glyph):
+        """Returns the name of the special character for a glyph."""
+        return self.names[glyph - glyph_base]
+
+    def tokenize(self, message):
+        """Returns the glyph sequence of a message. An opening ~[ without a closing bracket is kept as plain text."""
+        if message in self.cache:
+            glyphs = self.cache.pop(message)
+            self.cache[message] = glyphs
+            return glyphs
+        glyphs = []
+        position = 0
+        for match in special_character_pattern.finditer(message):
+            glyphs.extend(self.characters(message[position:match.start()]))
+            glyphs.append(self.lookup(match.group(1)))
+            position = match.end()
+        glyphs.extend(self.characters(message[position:]))
+        glyphs = tuple(glyphs)
+        if len(self.cache) >= self.cache_size:
+            # Evict the message that was used least recently.
+            self.cache.popitem(last=False)
+        self.cache[message] = glyphs
+        return glyphs
+
+    def characters(self, text):
+        """Returns the glyphs of plain text. Characters the display cannot show are replaced by question marks."""
+        return [ord(c) if ord(c) < glyph_base else undefined_character for c in text]
+
+    def to_text(self, glyphs):
+        """Turns a glyph sequence back into a message with ~[NAME] codes."""
+        text = ""
+        for glyph in glyphs:
+            if glyph >= glyph_base:
+                text += "~[%s]" % self.name(glyph)
+            else:
+                text += chr(glyph)
+        return text
+
+tokenizer = glyph_tokenizer(theme.symbol)
+
+class layout_engine(object):
+    """Lays out messages into the lines of glyphs that widgets display. Text is wrapped by glyph cells (a special
+    character takes one cell), or at spaces with word wrap, and every line is justified to the width of the widget.
+    Layouts are kept in a least-recently-used cache of limited size, keyed by the message and the geometry and
+    justification of the widget, so writing the same message again costs a dictionary lookup."""
+    def __init__(self, cache_size=256):
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+
+    def key(self, message, width, height, justification=left, word_wrap=False):
+        """Returns the cache key of a layout, or None if the message can't be cached."""
+        if type(message) in (str, int, float):
+            # The type is part of the key, because 1 and 1.0 are equal but look different.
+            return (type(message), message, width, height, justification, word_wrap)
+        try:
+            return (tuple, tuple(str(line) for line in message), width, height, justification, word_wrap)
+        except TypeError:
+            return None
+
+    def layout(self, message, width, height, justification=left, word_wrap=False, key=None):
+        """Returns the lines of a message as a tuple of glyph tuples. A single string is wrapped over the height of the
+        widget, a number is shown on the first line, and every item of a list (or other sequence) goes on a line of its
+        own. Pass the key if you already have it."""
+        if key is None:
+            key = self.key(message, width, height, justification, word_wrap)
+        if key in self.cache:
+            lines = self.cache.pop(key)
+            self.cache[key] = lines
+            return lines
+        if type(message) is str:
+            lines = self.wrap(tokenizer.tokenize(message), width, height, word_wrap)
+        elif type(message) is int or type(message) is float:
+            lines = [tokenizer.tokenize(str(message))]
+        else:
+            lines = [tokenizer.tokenize(str(line)) for line in message][:height]
+        lines = tuple(self.justify(line, width, justification) for line in lines)
+        if key is not None:
+            if len(self.cache) >= self.cache_size:
+                # Evict the layout that was used least recently.
+                self.cache.popitem(last=False)
+            self.cache[key] = lines
+        return lines
+
+    def wrap(self, glyphs, width, height, word_wrap=False):
+        """Splits a glyph sequence into height lines of at most width cells. With word wrap, lines are broken at the
+        last space that fits, and the spaces at the break are left out; words longer than a line are split."""
+        lines = []
+        position = 0
+        for n in range(height):
+            if not word_wrap:
+                lines.append(glyphs[n * width:(n + 1) * width])
+                continue
+            while position < len(glyphs) and glyphs[position] == space:
+                position += 1
+            end = position + width
+            if end < len(glyphs) and glyphs[end] != space:
+                # Break at the last space on the line, if there is one.
+                for cell in range(end - 1, position, -1):
+                    if glyphs[cell] == space:
+                        end = cell
+                        break
+            line = glyphs[position:end]
+            while line and line[-1] == space:
+                line = line[:-1]
+            lines.append(line)
+            position = end
+        return lines
+
+    def justify(self, glyphs, width, justification=left):
+        """Pads a glyph sequence to width cells, according to the justification."""
+        padding = width - len(glyphs)
+        if padding <= 0:
+            return glyphs
+        if justification == right:
+            before = padding
+        elif justification == center:
+            # Pad the same way str.center does.
+            before = ("x" * len(glyphs)).center(width).index("x") if glyphs else 0
+        else:
+            before = 0
+        return (space,) * before + glyphs + (space,) * (padding - before)
+
+layouts = layout_engine()
+
+class compiled_theme(object):
+    """A theme in a compact, immutable form. Every symbol name gets a small integer id, and the bitmaps (as bytes) and
+    stdout symbols are stored in tuples indexed by that id. Themes are validated when they are compiled. Use
+    compile_theme or load_theme to create one."""
+    __slots__ = ("name", "version", "creator", "names", "ids", "fallbacks", "bitmaps", "undefined")
+
+    def __init__(self, name, version, creator, symbols):
+        names = sorted(symbols)
+        if "UNDEFINED" not in symbols:
+            names.append("UNDEFINED")
+        fallbacks = []
+        bitmaps = []
+        for symbol_name in names:
+            fallback, bitmap = symbols.get(symbol_name, ("?", [0] * 8))
+            if not isinstance(fallback, str) or len(fallback) != 1:
+                raise ValueError("Theme symbol %s: the stdout symbol must be a single character" % symbol_name)
+            if len(bitmap) != 8:
+                raise ValueError("Theme symbol %s: the bitmap must have 8 rows" % symbol_name)
+            for row in bitmap:
+                if not 0 <= row <= 31:
+                    raise ValueError("Theme symbol %s: bitmap rows must be 5 bit values (0-31)" % symbol_name)
+            fallbacks.append(fallback)
+            bitmaps.append(bytes(bytearray(bitmap)))
+        object.__setattr__(self, "name", name)
+        object.__setattr__(self, "version", version)
+        object.__setattr__(self, "creator", creator)
+        object.__setattr__(self, "names", tuple(names))
+        object.__setattr__(self, "ids", dict((symbol_name, n) for n, symbol_name in enumerate(names)))
+        object.__setattr__(self, "fallbacks", tuple(fallbacks))
+        object.__setattr__(self, "bitmaps", tuple(bitmaps))
+        object.__setattr__(self, "undefined", self.ids["UNDEFINED"])
+        for symbol_name in names:
+            tokenizer.intern(symbol_name)
+
+    def __setattr__(self, attribute, value):
+        raise AttributeError("Compiled themes can't be changed")
+
+    def lookup(self, name):
+        """Returns the id of a symbol name. Names that are not in the theme get the id of UNDEFINED."""
+        return self.ids.get(name, self.undefined)
+
+    def save(self, path):
+        """Saves the compiled theme to a file, which load_theme can read back without compiling again."""
+        data = {"format": theme_cache_format, "name": self.name, "version": self.version, "creator": self.creator,
+                "symbol": dict((symbol_name, (self.fallbacks[n], [row for row in bytearray(self.bitmaps[n])]))
+                               for n, symbol_name in enumerate(self.names))}
+        with open(path, "w") as f:
+            json.dump(data, f)
+
+theme_cache_format = 1
+
+def compile_theme(source):
+    """Compiles a theme. The source can be a theme module like theme.py, a dictionary with the same names, or just a
+    dictionary of symbols."""
+    if isinstance(source, compiled_theme):
+        return source
+    if isinstance(source, dict):
+        if "symbol" not in source:
+            source = {"symbol": source}
+        get = source.get
+    else:
+        get = lambda attribute, default=None: getattr(source, attribute, default)
+    return compiled_theme(get("name", ""), get("version", ""), get("creator", ""), get("symbol"))
+
+def load_theme(path, cache_path=None):
+    """Loads a theme from a file. The file is either a theme.py-style Python file, or a compiled theme saved by
+    compiled_theme.save. If a cache path is given, the compiled theme is saved there, and loaded from there as long as
+    the cache is newer than the theme file."""
+    if cache_path is not None and os.path.exists(cache_path) and \
+            os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        try:
+            return load_theme(cache_path)
+        except ValueError:
+            pass  # An outdated or broken cache is compiled again.
+    if path.endswith(".py"):
+        compiled = compile_theme(runpy.run_path(path))
+    else:
+        with open(path) as f:
+            data = json.load(f)
+        if data.get("format") != theme_cache_format:
+            raise ValueError("%s is not a compiled theme of a known format" % path)
+        compiled = compile_theme(data)
+    if cache_path is not None and cache_path != path:
+        compiled.save(cache_path)
+    return compiled
+
+default_theme = compile_theme(theme)
+
 class character_register_manager(object):
     """Manages the register of special characters in the LCD. My LCD has 8 slots available for special characters. These
-    special characters are defined by a list in the theme.py file. """
-    def __init__(self, display, number_of_characters=8):
+    special characters are defined by a list in the theme.py file.
+    Slots are keyed by the bitmap of a character, not by its name, so names with identical bitmaps share a slot, and a
+    bitmap that is still in a slot from an earlier upload is used again without writing it to the display.
+    The UI plans the register once per frame, with all special characters visible in that frame. Characters that are
+    on screen are never swapped out. If a frame needs more special characters than there are slots, the characters that
+    don't fit are shown as a fallback character: by default their ASCII representation from the theme."""
+    def __init__(self, display, number_of_characters=8, fallback=None):
         self.number_of_slots = number_of_characters
         self.character_names = []
         self.character_codes = []
         self.character_ages = []
+        self.slots = {}
+        self.name_codes = {}
         self.escape_codes = {
             0: "\x00",
             1: "\x01",
@@ -48,6 +319,9 @@ class character_register_manager(object):
         }
         self.character_age_counter = 0
         self.display = display
+        self.fallback = fallback
+        self.output = {}
+        self.pending_uploads = {}
 
     def add_character(self, character_name, character_code):
         """Add a character to the special character register of the display. This function manages the limited number
@@ -55,8 +329,11 @@ class character_register_manager(object):
         can be swapped from memory. Optimization of this function probably has a lot of effects on the UI, because
         writing to the LCD memory seems slow."""
         self.character_age_counter += 1
-        if character_name in self.character_names:
-            self.character_ages[self.character_names.index(character_name)] = self.character_age_counter
+        code = bytes(bytearray(character_code))
+        self.name_codes[character_name] = code
+        if code in self.slots:
+            self.character_names[self.slots[code]] = character_name
+            self.character_ages[self.slots[code]] = self.character_age_counter
         else:
             if len(self.character_names) >= self.number_of_slots:
                 new_position = self.character_ages.index(min(self.character_ages))
@@ -65,39 +342,375 @@ class character_register_manager(object):
                 self.character_names.append(1)
                 self.character_codes.append(1)
                 self.character_ages.append(1)
-            self.character_names[new_position] = character_name
-            self.character_codes[new_position] = character_code
-            self.character_ages[new_position] = self.character_age_counter
-            self.display.create_char(new_position, self.character_codes[new_position])
-        if max(self.character_ages) > self.number_of_slots + 100:
+            self.store(new_position, character_name, code)
+            self.flush_uploads()
+        self.limit_ages()
+
+    def plan_frame(self, characters):
+        """Plans the register for a frame. Characters is a list of (name, code, fallback) tuples of all special
+        characters visible in the frame, in order of appearance, with the code as bytes. Bitmaps already in the
+        register keep their slot. New bitmaps go to empty slots, or replace the bitmap that was visible longest ago;
+        bitmaps visible in this frame are never replaced. Returns the set of names of characters that are shown
+        differently than in the previous frame, because they moved into the register or fell back."""
+        self.character_age_counter += 1
+        visible = set(code for name, code, fallback in characters)
+        output = {}
+        for name, code, fallback in characters:
+            self.name_codes[name] = code
+            if code in self.slots:
+                slot = self.slots[code]
+                self.character_names[slot] = name
+                self.character_ages[slot] = self.character_age_counter
+                output[name] = self.escape_codes[slot]
+        for name, code, fallback in characters:
+            if name in output:
+                continue
+            if code in self.slots:
+                # Another name with the same bitmap was stored a moment ago.
+                output[name] = self.escape_codes[self.slots[code]]
+                continue
+            slot = self.free_slot(visible)
+            if slot is None:
+                output[name] = fallback if self.fallback is None else self.fallback
+            else:
+                self.store(slot, name, code)
+                output[name] = self.escape_codes[slot]
+        self.limit_ages()
+        changed = set(name for name in output if self.output.get(name) != output[name])
+        self.output = output
+        return changed
+
+    def free_slot(self, visible):
+        """Returns a slot that can take a new bitmap without disturbing the bitmaps in visible, or None."""
+        if len(self.character_names) < self.number_of_slots:
+            self.character_names.append(1)
+            self.character_codes.append(1)
+            self.character_ages.append(1)
+            return len(self.character_names) - 1
+        slot = None
+        for n, code in enumerate(self.character_codes):
+            if code not in visible and (slot is None or self.character_ages[n] < self.character_ages[slot]):
+                slot = n
+        return slot
+
+    def store(self, slot, character_name, character_code):
+        """Puts a bitmap in a slot and queues its upload to the display."""
+        if self.slots.get(self.character_codes[slot]) == slot:
+            del self.slots[self.character_codes[slot]]
+        self.character_names[slot] = character_name
+        self.character_codes[slot] = character_code
+        self.character_ages[slot] = self.character_age_counter
+        self.slots[character_code] = slot
+        self.pending_uploads[slot] = character_code
+
+    def flush_uploads(self):
+        """Uploads the queued bitmaps to the display, all at once if the display supports create_chars. Returns the
+        number of bitmaps uploaded. If the upload fails, the bitmaps stay queued."""
+        if not self.pending_uploads:
+            return 0
+        if hasattr(self.display, "create_chars"):
+            self.display.create_chars(self.pending_uploads)
+        else:
+            for slot in sorted(self.pending_uploads):
+                self.display.create_char(slot, self.pending_uploads[slot])
+        uploaded = len(self.pending_uploads)
+        self.pending_uploads = {}
+        return uploaded
+
+    def limit_ages(self):
+        if max(self.character_ages or [0]) > self.number_of_slots + 100:
             # Reset the ages so no overflow occurs
             sorted_ages = sorted(self.character_ages)
             for n, i in enumerate(self.character_ages):
                 self.character_ages[n] = sorted_ages.index(i)
             self.character_age_counter = self.number_of_slots + 1
 
+    def get_output(self, character):
+        """Returns the character to send to the display for a special character in the current frame."""
+        return self.output[character]
+
     def length(self):
         return len(self.character_names)
 
     def get_escape_code(self, character):
-        return self.escape_codes[self.character_names.index(character)]
+        return self.escape_codes[self.get_slot(character)]
 
     def get_slot(self, character):
-        return self.character_names.index(character)
+        return self.slots[self.name_codes[character]]
 
     def get_character(self, slot):
         return self.character_names[slot]
 
     def get_code(self, character):
-        return self.character_codes[self.character_names.index(character)]
+        return self.character_codes[self.get_slot(character)]
 
     def print_register(self):
         for i, character in enumerate(self.character_names):
             print("Slot %s, character name %s, code %s, age %s" % (i, character, self.character_codes[i], self.character_ages[i]))
 
+class framebuffer(object):
+    """Holds the screen as one glyph per cell in two arrays. Widgets are composed into the back buffer, which is then
+    compared to the front buffer, holding what is on the display. After a flush the buffers are swapped, and only the
+    spans that were composed are copied back so both buffers hold the same frame again."""
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.back = array.array("H", [space] * (width * height))
+        self.front = array.array("H", [unknown_glyph] * (width * height))
+
+    def clear(self):
+        """Blanks the back buffer."""
+        for n in range(len(self.back)):
+            self.back[n] = space
+
+    def invalidate(self, row=None):
+        """Forgets what is on the display (or on one row of it), so every cell is seen as changed on the next flush."""
+        if row is None:
+            cells = range(len(self.front))
+        else:
+            cells = range(row * self.width, (row + 1) * self.width)
+        for n in cells:
+            self.front[n] = unknown_glyph
+
+    def fill(self, row, start, end, glyph):
+        """Fills the columns from start up to end of a row in the back buffer with a single glyph."""
+        base = row * self.width
+        for n in range(base + start, base + end):
+            self.back[n] = glyph
+
+    def blit(self, row, col, glyphs, start, end):
+        """Copies the part of a glyph sequence at column col that falls between columns start and end into a row of
+        the back buffer."""
+        start = max(start, col)
+        end = min(end, col + len(glyphs), self.width)
+        base = row * self.width
+        for n in range(start, end):
+            self.back[base + n] = glyphs[n - col]
+
+    def get_row(self, row, buffer=None):
+        """Returns one row of the back buffer (or of the given buffer)."""
+        if buffer is None:
+            buffer = self.back
+        return buffer[row * self.width:(row + 1) * self.width]
+
+    def changed_runs(self, row, spans):
+        """Returns the (start, end) columns of the runs of cells within the spans of a row that differ between the back
+        and the front buffer."""
+        runs = []
+        base = row * self.width
+        back = self.back
+        front = self.front
+        for start, end in spans:
+            if back[base + start:base + end] == front[base + start:base + end]:
+                continue
+            run_start = None
+            for n in range(start, end):
+                if back[base + n] != front[base + n]:
+                    if run_start is None:
+                        run_start = n
+                elif run_start is not None:
+                    runs.append((run_start, n))
+                    run_start = None
+            if run_start is not None:
+                runs.append((run_start, end))
+        return runs
+
+    def special_glyphs(self):
+        """Returns the special character glyphs in the back buffer, in order of appearance."""
+        glyphs = []
+        seen = set()
+        for glyph in self.back:
+            if glyph >= glyph_base and glyph not in seen:
+                seen.add(glyph)
+                glyphs.append(glyph)
+        return glyphs
+
+    def invalidate_glyphs(self, glyphs):
+        """Marks the cells of the front buffer showing any of the glyphs as unknown, so they are written again on the
+        next flush. Returns the (row, col, width, height) regions of these cells."""
+        regions = []
+        for n, glyph in enumerate(self.front):
+            if glyph in glyphs:
+                self.front[n] = unknown_glyph
+                regions.append((n // self.width, n % self.width, 1, 1))
+        return regions
+
+    def swap(self, spans):
+        """Makes the back buffer the front buffer after a flush. The spans that were composed in this frame are copied
+        into the new back buffer, which makes it equal to the front buffer again."""
+        self.front, self.back = self.back, self.front
+        for row, row_spans in spans.items():
+            base = row * self.width
+            for start, end in row_spans:
+                self.back[base + start:base + end] = self.front[base + start:base + end]
+
+class redraw_plan(object):
+    """Plans the display commands needed to turn the lines that are on the display into new lines. Changed cells are
+    grouped into runs per row. Between two runs, the planner either moves the cursor (one DDRAM address command) or
+    rewrites the unchanged characters in between, whichever is cheaper according to the cost model. The plan can be
+    inspected before it is applied to a display."""
+    def __init__(self, cursor_cost=1, character_cost=1):
+        self.cursor_cost = cursor_cost
+        self.character_cost = character_cost
+        self.operations = []
+        self.cells_changed = 0
+        self.cursor = None
+
+    def add_row(self, row, line, runs=None):
+        """Adds runs of changed cells of one row to the plan. The runs are (start, end) columns into the text of the
+        line. Without runs, the whole line is written."""
+        if runs is None:
+            runs = [(0, len(line))]
+        for start, end in runs:
+            self.cells_changed += end - start
+            if self.cursor is not None and self.cursor[1] == row and self.cursor[0] <= start and \
+                    (start - self.cursor[0]) * self.character_cost <= self.cursor_cost:
+                # Rewriting the unchanged characters up to the run is cheaper than moving the cursor.
+                start = self.cursor[0]
+            else:
+                self.operations.append(("cursor", start, row))
+            if self.operations[-1][0] == "message":
+                self.operations[-1] = ("message", self.operations[-1][1] + line[start:end])
+            else:
+                self.operations.append(("message", line[start:end]))
+            self.cursor = (end, row)
+
+    def cost(self):
+        """Returns the cost of the plan according to the cost model."""
+        cost = 0
+        for operation in self.operations:
+            if operation[0] == "cursor":
+                cost += self.cursor_cost
+            else:
+                cost += len(operation[1]) * self.character_cost
+        return cost
+
+    def naive_cost(self):
+        """Returns the cost of moving the cursor to every changed cell and writing it separately."""
+        return self.cells_changed * (self.cursor_cost + self.character_cost)
+
+    def apply(self, display):
+        """Sends the planned commands to the display. A failing command doesn't stop the rest of the plan. Returns a
+        list of (operation, exception) tuples of the commands that failed."""
+        errors = []
+        for operation in self.operations:
+            try:
+                if operation[0] == "cursor":
+                    display.set_cursor(operation[1], operation[2])
+                else:
+                    display.message(operation[1])
+            except Exception as e:
+                errors.append((operation, e))
+        return errors
+
+    def failed_rows(self, errors):
+        """Returns the rows that may not show what was planned after the commands in errors (as returned by apply)
+        failed, or None if that can't be told: after a failed cursor move, text goes to an unknown place."""
+        failed = [operation for operation, error in errors]
+        rows = set()
+        row = None
+        for operation in self.operations:
+            if operation[0] == "cursor":
+                if any(operation is f for f in failed):
+                    return None
+                row = operation[2]
+            elif any(operation is f for f in failed):
+                rows.add(row)
+        return rows
+
+def percentile(values, percent):
+    """Returns a percentile (nearest rank) of values, leaving out None values. Returns None if there are no values."""
+    values = sorted(value for value in values if value is not None)
+    if not values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+def schedule_frame(next_frame, period, now):
+    """Returns the time of the frame after the one due at next_frame, and the number of frames missed. If a frame took
+    longer than its time slot, the frames that can no longer be drawn in time are dropped instead of being drawn
+    late."""
+    next_frame += period
+    missed = 0
+    if now > next_frame:
+        missed = int((now - next_frame) / period) + 1
+        next_frame += missed * period
+    return next_frame, missed
+
+class frame_statistics(object):
+    """Counters and timings of a single frame. Times are in seconds. latency is the time from the first change to a
+    widget shown in the frame until the frame was flushed to the display, or None if the frame shows no widget
+    changes."""
+    counters = ("widgets_composed", "cells_changed", "characters_written", "cursor_moves", "display_shifts",
+                "cgram_uploads", "bus_errors")
+    timings = ("compose_time", "flush_time", "frame_time", "latency")
+
+    def __init__(self, number, start):
+        self.number = number
+        self.start = start
+        self.changed_since = None
+        self.widgets_composed = 0
+        self.cells_changed = 0
+        self.characters_written = 0
+        self.cursor_moves = 0
+        self.display_shifts = 0
+        self.cgram_uploads = 0
+        self.bus_errors = 0
+        self.compose_time = 0.0
+        self.flush_time = 0.0
+        self.frame_time = 0.0
+        self.latency = None
+
+    def as_dict(self):
+        """Returns the statistics of the frame as a dictionary."""
+        result = {"number": self.number, "start": self.start}
+        for name in self.counters + self.timings:
+            result[name] = getattr(self, name)
+        return result
+
+class render_statistics(object):
+    """Collects the statistics of drawn frames: totals of all counters since the start, the last frames for rolling
+    percentiles, and a histogram of the input-to-flush latency. The upper bounds of the histogram buckets are in
+    seconds; the last bucket counts everything slower."""
+    latency_buckets = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+
+    def __init__(self, window=256):
+        self.frames = collections.deque(maxlen=window)
+        self.totals = dict((name, 0) for name in frame_statistics.counters)
+        self.frames_drawn = 0
+        self.idle_frames = 0
+        self.latency_histogram = [0] * (len(self.latency_buckets) + 1)
+
+    def add(self, frame):
+        """Adds the statistics of a drawn frame."""
+        self.frames_drawn += 1
+        self.frames.append(frame)
+        for name in frame_statistics.counters:
+            self.totals[name] += getattr(frame, name)
+        if frame.latency is not None:
+            bucket = 0
+            while bucket < len(self.latency_buckets) and frame.latency > self.latency_buckets[bucket]:
+                bucket += 1
+            self.latency_histogram[bucket] += 1
+
+    def percentile(self, name, percent):
+        """Returns a percentile (nearest rank) of a timing over the last frames, or None if there is no data."""
+        return percentile([getattr(frame, name) for frame in self.frames], percent)
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """Returns the statistics as a dictionary of plain values."""
+        result = {"frames_drawn": self.frames_drawn, "idle_frames": self.idle_frames}
+        result.update(self.totals)
+        for name in frame_statistics.timings:
+            result[name] = dict(("p%s" % percent, self.percentile(name, percent)) for percent in percentiles)
+        result["latency_histogram"] = dict(zip([str(bound) for bound in self.latency_buckets] + ["inf"],
+                                               self.latency_histogram))
+        result["last_frame"] = self.frames[-1].as_dict() if self.frames else None
+        return result
+
 class ui(object):
     """Basic ui object. This object contains all drawable widgets and is responsible for the draw action."""
-    def __init__(self, display=None, width=20, height=4, rgb=(1.0, 1.0, 1.0)):
+    def __init__(self, display=None, width=20, height=4, rgb=(1.0, 1.0, 1.0), log_size=100):
         self.display = display
         self.widgets = []
         self.rgb = rgb
@@ -105,32 +718,75 @@ class ui(object):
         self.width = width
         self.height = height
         self.loglines = []
-        self.displaylines = []
-        self.current_displaylines = []
+        self.log_size = log_size
+        self.framebuffer = framebuffer(width, height)
         self.optimize_redraw = False
+        self.cursor_cost = 1
+        self.character_cost = 1
+        self.last_plan = None
+        self.dirty_regions = []
+        self.drawn_versions = {}
+        self.drawn_rects = {}
+        self.lock = threading.RLock()
+        self.render_thread = None
+        self.render_stop = threading.Event()
+        self.frame_times = collections.deque(maxlen=64)
+        self.dropped_frames = 0
+        self.coalesced_updates = 0
+        self.executor = None
+        self.queued_redraw = None
+        self.queue_lock = threading.Lock()
+        self.statistics = render_statistics()
+        self.frame = None
+        self.pre_frame_hooks = []
+        self.post_frame_hooks = []
+        self.changed_widgets = []
+        self.failed_rows = set()
+        self.row_index = None
+        self.indexed_rects = {}
+        self.hardware_scroll = False
+        self.shift_widget = None
+        self.shift_text = None
+        self.shift_offset = 0
         self.clear()
         self.number_of_character_memory_slots = 8
         self.theme_stdout = 0
         self.theme_display = 1
+        self.theme = default_theme
         self.register = character_register_manager(self.display, self.number_of_character_memory_slots)
+        self.glyph_output = {}
+        self.glyph_ids = {}
+        self.index_glyphs()
 
     def clear(self):
         """Clear all content lines from the UI. The UI-object manages clearing the display itself."""
-        self.displaylines = []
-        for n in range(self.height):
-            self.displaylines.append(' ' * self.width)
+        self.framebuffer.clear()
+        self.mark_dirty(0, 0, self.width, self.height)
+
+    def mark_dirty(self, row, col, width, height):
+        """Marks an area of the screen to be composed again on the next redraw. Widgets mark themselves when they
+        change, so this is only needed for changes the UI cannot see."""
+        self.dirty_regions.append((row, col, width, height))
+
+    def invalidate_display(self):
+        """Forgets what is on the display, so the next redraw writes every cell again. Call this if something else
+        wrote to the display."""
+        self.framebuffer.invalidate()
+        self.mark_dirty(0, 0, self.width, self.height)
 
     def add_widget(self, widget, row, col):
         """Add a widget to the UI. The widgets are drawn in the order in which they are registered.
         Widget objects are first created, and then added to the UI-object."""
-        widget.row = row
-        widget.col = col
-        if (widget.row + widget.height <= self.height) and (widget.col + widget.width <= self.width):
-            self.widgets.append(widget)
-            return True
-        else:
-            self.loglines.append("Failed to add widget %s: widget out of bounds" % (widget))
-            return False
+        with self.lock:
+            widget.row = row
+            widget.col = col
+            if (widget.row + widget.height <= self.height) and (widget.col + widget.width <= self.width):
+                self.widgets.append(widget)
+                self.row_index = None
+                return True
+            else:
+                self.log("Failed to add widget %s: widget out of bounds" % (widget))
+                return False
 
     def remove_widget(self, widget_name):
         """Remove a widget from the UI widget list. To remove a widget, it needs to have a proper name. You can
@@ -138,87 +794,578 @@ class ui(object):
         Note that this doesn't delete the object itself, it just takes it from the UI widget list. You can add it to
         the list again later."""
         reply = False
-        for i, widget in enumerate(self.widgets):
-            if widget.name == widget_name:
-                self.loglines.append("Deleted widget %s (%s)" % (widget.name, widget))
-                del self.widgets[i]
-                reply = True
+        with self.lock:
+            for i, widget in enumerate(self.widgets):
+                if widget.name == widget_name:
+                    self.log("Deleted widget %s (%s)" % (widget.name, widget))
+                    if widget in self.drawn_rects:
+                        self.mark_dirty(*self.drawn_rects.pop(widget))
+                        del self.drawn_versions[widget]
+                    del self.widgets[i]
+                    self.row_index = None
+                    reply = True
         return reply
 
     def list_widgets(self):
         return self.widgets
 
     def redraw(self):
-        """Redraw all widgets. Add this function to your main loop to update your display."""
-        self.clear()
-        for widget in self.widgets:
-            for i, line in enumerate(widget.get_contents()):
-                # The line is cut to the width permitted by the widget, but is also extended to allow for special characters.
-                # These characters are represented by several characters, but are just a single character in the output.
-                line = line[:widget.width+len(line)-self.length_of_string_with_special_characters(line)]
-                if self.display is None:
-                    line = self.replace_special_characters_for_stdout(line)
-                else:
-                    line = self.replace_special_characters_for_display(line)
-                if i <= widget.height:
-                    #This ensures that no lines are written beyond the capacity of the widget
-                    # !! Also, if the line contains special characters, it may be cut short buy this function right now.
-                    self.displaylines[widget.row+i] = self.displaylines[widget.row+i][:widget.col] + line + self.displaylines[widget.row+i][widget.col+len(line):]
-
-        if self.display is None:
+        """Redraw all widgets. Add this function to your main loop to update your display, or call start() to have
+        the UI redraw itself. Only the parts of the screen covered by widgets that changed since the last redraw are
+        composed again; if nothing changed, nothing is written at all."""
+        with self.lock:
+            self.frame_times.append(time.time())
+            self.draw_frame()
+
+    def draw_frame(self):
+        """Composes and flushes one frame. For internal use; call redraw instead."""
+        start = time.time()
+        self.frame = frame_statistics(self.statistics.frames_drawn + 1, start)
+        spans = self.collect_dirty_spans()
+        if not spans:
+            self.statistics.idle_frames += 1
+            self.frame = None
+            return
+        try:
+            self.draw_spans(spans, start)
+        except Exception:
+            # The changes collected for this frame were not shown; they are drawn in the next frame.
+            for row, row_spans in spans.items():
+                for span_start, span_end in row_spans:
+                    self.mark_dirty(row, span_start, span_end - span_start, 1)
+            self.failed_rows = set()
+            self.frame = None
+            raise
+
+    def draw_spans(self, spans, start):
+        """Composes the dirty spans of a frame and shows them on the display. For internal use by draw_frame."""
+        self.run_hooks(self.pre_frame_hooks)
+        self.frame.widgets_composed = self.compose(spans)
+        compose_end = time.time()
+        self.frame.compose_time = compose_end - start
+        shifted = False
+        if self.display is not None:
+            marquee = self.hardware_scroll_widget(spans) if self.hardware_scroll else None
+            regions = self.plan_character_register(marquee.strip if marquee is not None else ())
+            if marquee is not None and not regions:
+                shifted = self.scroll_in_hardware(marquee)
+            if not shifted and self.shift_widget is not None:
+                regions.extend(self.stop_hardware_scroll())
+            if regions:
+                spans = self.merge_spans(spans, regions)
+
+        if shifted:
+            pass  # The frame was shown by shifting the display.
+        elif self.display is None:
             # Because there is no lcd defined, the output goes to stdout. This draws a small frame around the output for
-            # debugging purposes.
+            # debugging purposes. For simulations, a libLCDUI_terminal.terminal_display only writes the cells that change.
             print("*" + "-" * self.width + "*")
-            for line in self.displaylines:
-                print("|" + line[:self.width] + "|")
+            for row in range(self.height):
+                print("|" + self.stdout_text(self.framebuffer.get_row(row)) + "|")
             print("*" + "-" * self.width + "*")
         else:
             if self.optimize_redraw:
-                for row, line in enumerate(self.displaylines):
-                    for column, character in enumerate(line):
-                        if self.displaylines[row][column] != self.current_displaylines[row][column]:
-                            try:
-                                self.display.set_cursor(column, row)
-                                self.display.message(character)
-                            except:
-                                print("Display error in line '%s'" % line[:self.width])
+                self.last_plan = self.plan_redraw(spans)
+                errors = self.last_plan.apply(self.display)
+                for operation, error in errors:
+                    self.display_error("operation %s" % (operation,), error)
+                if errors:
+                    self.display_failed(self.last_plan.failed_rows(errors))
+                self.frame.cells_changed = self.last_plan.cells_changed
+                for operation in self.last_plan.operations:
+                    if operation[0] == "cursor":
+                        self.frame.cursor_moves += 1
+                    else:
+                        self.frame.characters_written += len(operation[1])
             else:
-                for row, line in enumerate(self.displaylines):
+                for row in sorted(spans):
+                    for run_start, run_end in self.framebuffer.changed_runs(row, spans[row]):
+                        self.frame.cells_changed += run_end - run_start
+                    line = self.display_text(self.framebuffer.get_row(row))
                     try:
                         self.display.set_cursor(0, row)
-                        self.display.message(line[:self.width])
-                    except:
-                        print("Display error in line '%s'" % line[:self.width])
+                        self.frame.cursor_moves += 1
+                        self.display.message(line)
+                        self.frame.characters_written += len(line)
+                    except Exception as e:
+                        self.display_error("line '%s'" % line, e)
+                        self.display_failed([row])
+
+            if hasattr(self.display, "flush"):
+                # Displays that buffer their output, like the terminal display, write it once per frame.
+                try:
+                    self.display.flush()
+                except Exception as e:
+                    self.display_error("flush", e)
+                    self.display_failed()
+
+        # The back buffer becomes the front buffer, which holds the information that is currently being displayed. This
+        # helps us to compare if there is any new information to be displayed.
+        self.framebuffer.swap(spans)
+        for row in sorted(self.failed_rows):
+            # Writing to these rows failed; they are written again in the next frame.
+            self.framebuffer.invalidate(row)
+            self.mark_dirty(row, 0, self.width, 1)
+        self.failed_rows = set()
+        end = time.time()
+        self.frame.flush_time = end - compose_end
+        self.frame.frame_time = end - start
+        if self.frame.changed_since is not None:
+            self.frame.latency = end - self.frame.changed_since
+        self.statistics.add(self.frame)
+        self.run_hooks(self.post_frame_hooks)
+        self.frame = None
+
+    def log(self, line):
+        """Adds a line to the log. Only the latest log_size lines are kept, so a display or a source that keeps failing
+        doesn't fill the memory."""
+        self.loglines.append(line)
+        if len(self.loglines) > self.log_size:
+            del self.loglines[:-self.log_size]
+
+    def display_error(self, what, error):
+        """Counts and logs an error of the display (usually of the bus it is connected to)."""
+        self.frame.bus_errors += 1
+        self.log("Display error in %s: %s" % (what, error))
+
+    def display_failed(self, rows=None):
+        """Notes that rows of the display (all rows if rows is None) may not show what was sent to them, because writing
+        to the display failed. At the end of the frame, these rows are forgotten, so the next frame writes them
+        again."""
+        if rows is None:
+            rows = range(self.height)
+        self.failed_rows.update(rows)
+
+    def run_hooks(self, hooks):
+        """Calls frame hooks with the UI and the statistics of the frame. Errors in hooks are logged, but don't stop the
+        frame."""
+        for hook in hooks:
+            try:
+                hook(self, self.frame)
+            except Exception as e:
+                self.log("Error in frame hook %s: %s" % (hook, e))
+
+    def add_frame_hook(self, pre_frame=None, post_frame=None):
+        """Adds callbacks that are called before a frame is composed and after it was flushed to the display, with the
+        UI and the frame_statistics of the frame as arguments. The statistics are filled in while the frame is drawn;
+        post-frame hooks see the complete statistics. Hooks are called on the thread that draws the frame, with the
+        lock of the UI held, and only for frames in which something changed."""
+        with self.lock:
+            if pre_frame is not None:
+                self.pre_frame_hooks.append(pre_frame)
+            if post_frame is not None:
+                self.post_frame_hooks.append(post_frame)
+
+    def remove_frame_hook(self, hook):
+        """Removes a pre-frame or post-frame hook."""
+        with self.lock:
+            if hook in self.pre_frame_hooks:
+                self.pre_frame_hooks.remove(hook)
+            if hook in self.post_frame_hooks:
+                self.post_frame_hooks.remove(hook)
+
+    def stats(self):
+        """Returns the render statistics as a dictionary: the totals of the frame counters, percentiles of the compose,
+        flush and frame times and of the input-to-flush latency over the last frames (in seconds), a histogram of the
+        latency, the statistics of the last frame, and the dropped frames, coalesced updates and achieved frame
+        rate."""
+        with self.lock:
+            result = self.statistics.summary()
+            result["dropped_frames"] = self.dropped_frames
+            result["coalesced_updates"] = self.coalesced_updates
+            result["achieved_fps"] = self.achieved_fps()
+            return result
+
+    def collect_dirty_spans(self):
+        """Finds the parts of the screen that have to be composed again. A widget is dirty if its version changed or if
+        it moved since it was last drawn; both the area it covered then and the area it covers now are recomposed.
+        Returns a dictionary of row numbers to sorted, non-overlapping (start, end) column spans."""
+        regions = self.dirty_regions
+        self.dirty_regions = []
+        self.changed_widgets = []
+        now = time.time()
+        if len(self.indexed_rects) != len(self.widgets):
+            self.row_index = None
+        for widget in self.widgets:
+            try:
+                widget.update(now)
+            except Exception as e:
+                self.log("Error updating widget %s: %s" % (widget.name, e))
+            rect = (widget.row, widget.col, widget.width, widget.height)
+            if self.indexed_rects.get(widget) != rect:
+                # The widget moved, or is new.
+                self.row_index = None
+            if self.drawn_versions.get(widget) != widget.version or self.drawn_rects.get(widget) != rect:
+                if widget.changed_at is not None:
+                    if self.frame.changed_since is None or widget.changed_at < self.frame.changed_since:
+                        self.frame.changed_since = widget.changed_at
+                    widget.changed_at = None
+                if widget in self.drawn_versions and widget.version - self.drawn_versions[widget] > 1:
+                    # The widget changed more than once since the last frame; these updates end up in a single frame.
+                    self.coalesced_updates += widget.version - self.drawn_versions[widget] - 1
+                if widget in self.drawn_rects:
+                    regions.append(self.drawn_rects[widget])
+                regions.append(rect)
+                self.changed_widgets.append(widget)
+                self.drawn_versions[widget] = widget.version
+                self.drawn_rects[widget] = rect
+        return self.merge_spans({}, regions)
+
+    def merge_spans(self, spans, regions):
+        """Adds (row, col, width, height) regions to a dictionary of row numbers to sorted, non-overlapping (start, end)
+        column spans. Returns the merged dictionary."""
+        for row, col, width, height in regions:
+            start = max(col, 0)
+            end = min(col + width, self.width)
+            if end <= start:
+                continue
+            for r in range(max(row, 0), min(row + height, self.height)):
+                spans.setdefault(r, []).append((start, end))
+        for row, row_spans in spans.items():
+            row_spans.sort()
+            merged = [row_spans[0]]
+            for start, end in row_spans[1:]:
+                if start <= merged[-1][1]:
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+                else:
+                    merged.append((start, end))
+            spans[row] = merged
+        return spans
+
+    def plan_character_register(self, extra_glyphs=()):
+        """Plans the special character register for the composed frame, uploading new characters to the display.
+        Extra glyphs, which are not visible but are about to be, are kept in the register as well.
+        Returns the regions of cells that have to be written again because their special character moved into the
+        register or fell back to its ASCII representation."""
+        characters = []
+        names = {}
+        glyphs = self.framebuffer.special_glyphs()
+        for glyph in extra_glyphs:
+            if glyph >= glyph_base and glyph not in glyphs:
+                glyphs.append(glyph)
+        for glyph in glyphs:
+            if glyph not in self.glyph_ids:
+                self.index_glyphs()
+            names[glyph] = tokenizer.name(glyph)
+            theme_id = self.glyph_ids[glyph]
+            characters.append((names[glyph], self.theme.bitmaps[theme_id], self.theme.fallbacks[theme_id]))
+        changed = self.register.plan_frame(characters)
+        try:
+            self.frame.cgram_uploads = self.register.flush_uploads()
+        except Exception as e:
+            self.display_error("upload of special characters", e)
+            # The bitmaps stay queued; drawing all rows again in the next frame uploads them and rewrites their cells.
+            self.display_failed()
+        self.glyph_output = {}
+        for glyph, name in names.items():
+            self.glyph_output[glyph] = self.register.get_output(name)
+        return self.framebuffer.invalidate_glyphs(set(glyph for glyph, name in names.items() if name in changed))
+
+    def set_hardware_scroll(self, hardware_scroll=True):
+        """Lets the UI scroll a marquee by shifting the display, instead of writing the row again for every step. The
+        HD44780 shifts all rows at once, so this is only done on displays of up to two rows, when a scrolltext that
+        spans the full width of the display is the only widget that changes and every other row shows a single
+        character (usually an empty row). The complete line is then written into the 40 character memory of its row
+        once, and every step is a single shift command. In all other frames, the display is shifted back and drawn as
+        usual."""
+        with self.lock:
+            self.hardware_scroll = hardware_scroll
+            if self.shift_widget is not None:
+                # Draw a frame, in which the display is shifted back.
+                self.mark_dirty(self.shift_widget.row, 0, self.width, 1)
+
+    def hardware_scroll_widget(self, spans):
+        """Returns the scrolltext that can be shown by shifting the display in this frame, or None."""
+        if self.height > 2 or not hasattr(self.display, "move_left") or len(self.changed_widgets) != 1:
+            return None
+        marquee = self.changed_widgets[0]
+        if not isinstance(marquee, scrolltext) or marquee.strip is None or not marquee.visible or \
+                marquee.col != 0 or marquee.width != self.width or marquee.height != 1 or \
+                len(marquee.strip) > 40 or marquee.row not in spans or len(spans) != 1:
+            return None
+        row_index = self.row_index
+        if row_index is None:
+            row_index = self.index_widgets()
+        for widget in row_index.get(marquee.row, ()):
+            if widget is not marquee and widget.visible:
+                return None
+        for row in range(self.height):
+            if row != marquee.row and len(set(self.framebuffer.get_row(row))) != 1:
+                return None
+        return marquee
+
+    def scroll_in_hardware(self, marquee):
+        """Shows the current frame of a marquee by shifting the display. Returns False if that failed."""
+        offset = marquee.ring_offsets[marquee.ring_position]
+        try:
+            text = self.display_text(marquee.strip)
+            if marquee is not self.shift_widget or text != self.shift_text:
+                self.start_hardware_scroll(marquee, text)
+            if offset == 0 and self.shift_offset > 1:
+                self.display.home()
+                self.frame.display_shifts += 1
+            elif offset > self.shift_offset:
+                for _ in range(offset - self.shift_offset):
+                    self.display.move_left()
+                    self.frame.display_shifts += 1
+            else:
+                for _ in range(self.shift_offset - offset):
+                    self.display.move_right()
+                    self.frame.display_shifts += 1
+            self.shift_offset = offset
+            return True
+        except Exception as e:
+            self.display_error("hardware scroll", e)
+            # Nothing is known about the display anymore; start over in the usual way.
+            self.shift_widget = None
+            self.framebuffer.invalidate()
+            self.mark_dirty(0, 0, self.width, self.height)
+            return False
 
-        # Here we make a copy of the information that is currently being displayed. This helps us to compare if there
-        # is any new information to be displayed.
-        self.current_displaylines = self.displaylines[:]
+    def start_hardware_scroll(self, marquee, text):
+        """Writes the complete line of a marquee into the memory of its row, with the display shifted back. The other
+        rows are filled with their character across the full memory line, so they look the same in every position."""
+        self.display.home()
+        for row in range(self.height):
+            self.display.set_cursor(0, row)
+            self.frame.cursor_moves += 1
+            if row == marquee.row:
+                line = text
+            else:
+                line = self.display_text(self.framebuffer.get_row(row)[:1]) * 40
+            self.display.message(line)
+            self.frame.characters_written += len(line)
+        self.shift_widget = marquee
+        self.shift_text = text
+        self.shift_offset = 0
+
+    def stop_hardware_scroll(self):
+        """Shifts the display back. Returns the region of the marquee row, which has to be written again."""
+        row = self.shift_widget.row
+        self.shift_widget = None
+        self.shift_text = None
+        self.shift_offset = 0
+        try:
+            self.display.home()
+            self.frame.display_shifts += 1
+        except Exception as e:
+            self.display_error("hardware scroll", e)
+            self.framebuffer.invalidate()
+            return [(0, 0, self.width, self.height)]
+        self.framebuffer.invalidate(row)
+        return [(row, 0, self.width, 1)]
+
+    def index_glyphs(self):
+        """Builds the index of special character glyphs to their ids in the theme. Glyphs are added to the tokenizer as
+        new names are written, so the index is extended when the UI comes across a glyph it doesn't know yet."""
+        for n in range(len(self.glyph_ids), len(tokenizer.names)):
+            self.glyph_ids[glyph_base + n] = self.theme.lookup(tokenizer.names[n])
+
+    def set_theme(self, new_theme):
+        """Switches to another theme: a compiled theme, or anything compile_theme accepts. Only the cells showing
+        special characters that look different in the new theme are drawn again. Special characters that look the same
+        keep their slot in the register of the display."""
+        new_theme = compile_theme(new_theme)
+        with self.lock:
+            self.index_glyphs()
+            old_symbols = dict((glyph, self.symbol(glyph)) for glyph in self.glyph_ids)
+            self.theme = new_theme
+            self.glyph_ids = {}
+            self.index_glyphs()
+            changed = set(glyph for glyph in self.glyph_ids if self.symbol(glyph) != old_symbols[glyph])
+            if self.display is None:
+                self.mark_dirty(0, 0, self.width, self.height)
+            else:
+                self.dirty_regions.extend(self.framebuffer.invalidate_glyphs(changed))
+
+    def set_character_fallback(self, fallback=None):
+        """Sets the character shown for special characters that don't fit in the register of the display. By default
+        (None), the ASCII representation of the special character from the theme is shown."""
+        self.register.fallback = fallback
+        self.invalidate_display()
+
+    def compose(self, spans):
+        """Composes the dirty spans of the screen into the back buffer. Each span is blanked, after which the widgets
+        that overlap it are painted into it. The widgets of a row are found in the spatial index, and painted from the
+        top (the last one registered) down, each only into the cells no widget above it has painted. A widget that is
+        covered by the widgets above it is not composed at all. Returns the number of widgets composed."""
+        row_index = self.row_index
+        if row_index is None:
+            row_index = self.index_widgets()
+        contents = {}
+        for row, row_spans in spans.items():
+            for start, end in row_spans:
+                self.framebuffer.fill(row, start, end, space)
+            uncovered = row_spans
+            for widget in reversed(row_index.get(row, ())):
+                if not widget.visible:
+                    continue
+                widget_left = widget.col
+                widget_right = widget.col + widget.width
+                if not any(start < widget_right and end > widget_left for start, end in uncovered):
+                    continue
+                if widget not in contents:
+                    contents[widget] = widget.get_contents()
+                i = row - widget.row
+                if i >= len(contents[widget]):
+                    continue
+                glyphs = contents[widget][i]
+                # A widget covers the cells it paints, which may be fewer than its width.
+                widget_right = min(widget_right, widget_left + len(glyphs))
+                remaining = []
+                for start, end in uncovered:
+                    if start < widget_right and end > widget_left:
+                        self.framebuffer.blit(row, widget_left, glyphs, start, min(end, widget_right))
+                        if start < widget_left:
+                            remaining.append((start, widget_left))
+                        if end > widget_right:
+                            remaining.append((widget_right, end))
+                    else:
+                        remaining.append((start, end))
+                uncovered = remaining
+                if not uncovered:
+                    break
+        return len(contents)
+
+    def index_widgets(self):
+        """Builds the spatial index of the widgets: for every row, the widgets that overlap it, in the order in which
+        they were registered. Returns the index."""
+        row_index = {}
+        indexed_rects = {}
+        for widget in self.widgets:
+            for row in range(max(widget.row, 0), min(widget.row + widget.height, self.height)):
+                row_index.setdefault(row, []).append(widget)
+            indexed_rects[widget] = (widget.row, widget.col, widget.width, widget.height)
+        self.row_index = row_index
+        self.indexed_rects = indexed_rects
+        return row_index
+
+    def start(self, fps=10):
+        """Starts redrawing the UI on a render thread, at a fixed number of frames per second. Widgets can then simply
+        be written from the application; everything written between two frames ends up in the next frame. To make
+        several writes appear in the same frame, hold ui.lock while writing them."""
+        if self.render_thread is not None:
+            return
+        self.render_stop.clear()
+        self.render_thread = threading.Thread(target=self.render_loop, args=(fps,), name="libLCDUI render")
+        self.render_thread.daemon = True
+        self.render_thread.start()
+
+    def stop(self):
+        """Stops the render thread, after it has finished the frame it is drawing."""
+        if self.render_thread is None:
+            return
+        self.render_stop.set()
+        self.render_thread.join()
+        self.render_thread = None
+
+    def render_loop(self, fps):
+        """Main loop of the render thread. If a frame takes longer than its time slot, the frames that could not be
+        drawn in time are dropped instead of being drawn late."""
+        period = 1.0 / fps
+        next_frame = time.time()
+        while not self.render_stop.is_set():
+            try:
+                self.redraw()
+            except Exception as e:
+                self.log("Render error: %s" % e)
+            now = time.time()
+            next_frame, missed = schedule_frame(next_frame, period, now)
+            self.dropped_frames += missed
+            self.render_stop.wait(next_frame - now)
+
+    async def aredraw(self):
+        """Redraws the UI from asyncio code. The redraw runs on the executor of the display (or of the UI, if the
+        display doesn't have one), so bus I/O never blocks the event loop. Calls made while a redraw is still waiting
+        to start share that redraw, which will include their changes."""
+        with self.queue_lock:
+            future = self.queued_redraw
+            if future is None:
+                future = self.queued_redraw = self.get_executor().submit(self.run_queued_redraw)
+        await asyncio.shield(asyncio.wrap_future(future))
+
+    def run_queued_redraw(self):
+        """Runs a redraw queued by aredraw. Once the redraw starts, later calls to aredraw queue a new one."""
+        with self.queue_lock:
+            self.queued_redraw = None
+        self.redraw()
+
+    def get_executor(self):
+        """Returns the single thread executor used for the blocking I/O of asyncio code."""
+        if self.executor is None:
+            if hasattr(self.display, "executor"):
+                self.executor = self.display.executor()
+            else:
+                self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        return self.executor
+
+    def run_async(self, fps=10):
+        """Starts redrawing the UI from an asyncio task, at a fixed number of frames per second. Returns the task;
+        cancel it to stop redrawing."""
+        return asyncio.ensure_future(self.async_render_loop(fps))
+
+    async def async_render_loop(self, fps):
+        """Main loop of the task started by run_async. Like the render thread, it drops frames it can't draw in
+        time."""
+        period = 1.0 / fps
+        next_frame = time.time()
+        while True:
+            await self.aredraw()
+            now = time.time()
+            next_frame, missed = schedule_frame(next_frame, period, now)
+            self.dropped_frames += missed
+            await asyncio.sleep(next_frame - now)
+
+    def achieved_fps(self):
+        """Returns the number of frames per second over the last frames that were drawn."""
+        with self.lock:
+            if len(self.frame_times) < 2 or self.frame_times[-1] == self.frame_times[0]:
+                return 0.0
+            return (len(self.frame_times) - 1) / (self.frame_times[-1] - self.frame_times[0])
 
     def enable_display(self, switch):
-        self.display.enable_display(switch)
+        with self.lock:
+            self.display.enable_display(switch)
 
     def set_backlight(self, intensity):
-        self.display.set_backlight(intensity)
+        with self.lock:
+            self.display.set_backlight(intensity)
         self.intensity = intensity
 
     def set_color(self, red, green, blue):
         self.rgb = (red, green, blue)
-        self.display.set_color(red, green, blue)
+        with self.lock:
+            self.display.set_color(red, green, blue)
 
     def set_optimize_redraw(self, optimize_redraw = False):
         self.optimize_redraw = optimize_redraw
 
+    def set_redraw_costs(self, cursor_cost=1, character_cost=1):
+        """Sets the cost model used by the optimized redraw: the relative cost of moving the cursor and of writing one
+        character. On a HD44780 both are a single write to the display."""
+        self.cursor_cost = cursor_cost
+        self.character_cost = character_cost
+
+    def plan_redraw(self, spans):
+        """Plans the display commands that bring the dirty spans of the display up to date."""
+        plan = redraw_plan(self.cursor_cost, self.character_cost)
+        for row in sorted(spans):
+            runs = self.framebuffer.changed_runs(row, spans[row])
+            if runs:
+                plan.add_row(row, self.display_text(self.framebuffer.get_row(row)), runs)
+        return plan
+
     def print_widgets(self):
         """Print a list of all widgets to stdout. Mostly useful for debugging your interface."""
         for i, widget in enumerate(self.widgets):
             print("%s. %s, Type: %s; Location: r%s,c%s; Size: %sx%s. Visible=%s" % (i + 1, widget.name, type(widget), widget.row, widget.col, widget.width, widget.height, widget.visible))
 
     def print_theme(self):
-        print("Theme name: %s, version %s" % (theme.name, theme.version))
-        print("Created by %s" % theme.creator)
+        print("Theme name: %s, version %s" % (self.theme.name, self.theme.version))
+        print("Created by %s" % self.theme.creator)
 
     def print_errors(self):
-        """This prints all generated errors for debugging."""
+        """This prints the latest errors for debugging."""
         print(self.loglines)
 
     def print_all(self):
@@ -239,24 +1386,177 @@ class ui(object):
     def length_of_string_with_special_characters(self, s):
         """Find the length of a string if it contains special characters. This is necessary so that such strings are
         not cut off. Special characters are represented by ~[...], and should be counted as a single character."""
-        length_without_special_characters = len(re.sub("~\[(.*?)\]", "", s))
-        number_of_special_characters_found = len(re.findall("~\[(.*?)\]", s))
-        return length_without_special_characters + number_of_special_characters_found
+        return len(tokenizer.tokenize(s))
 
     def replace_special_characters_for_display(self, line):
         """Replaces codes for special characters by codes the LCD can interpret. Also registers special characters from
         the theme file to the LCD memory. LCDs can generally display up to 8 special characters. If this limit is
         reached, all further special characters are replaced by question marks."""
-        for match in re.findall("~\[(.*?)\]", line):
-            self.register.add_character(match, theme.symbol[match][self.theme_display])
-            line = line.replace("~[" + match + "]", self.register.get_escape_code(match))
-        return line
+        return self.display_text(tokenizer.tokenize(line))
 
     def replace_special_characters_for_stdout(self, line):
         """Replaces codes for special characters by characters for writing to stdout. """
-        for match in re.findall("~\[(.*?)\]", line):
-            line = line.replace("~[" + match + "]", theme.symbol[match][self.theme_stdout])
-        return line
+        return self.stdout_text(tokenizer.tokenize(line))
+
+    def symbol(self, glyph):
+        """Returns the (stdout symbol, bitmap) theme entry of a special character. Names that are not in the theme are
+        shown as UNDEFINED."""
+        if glyph not in self.glyph_ids:
+            self.index_glyphs()
+        theme_id = self.glyph_ids[glyph]
+        return (self.theme.fallbacks[theme_id], self.theme.bitmaps[theme_id])
+
+    def display_text(self, glyphs):
+        """Turns a glyph sequence into text for the LCD. Special characters that are not in the current frame are
+        registered immediately."""
+        characters = []
+        for glyph in glyphs:
+            if glyph < glyph_base:
+                characters.append(chr(glyph))
+            elif glyph in self.glyph_output:
+                characters.append(self.glyph_output[glyph])
+            else:
+                name = tokenizer.name(glyph)
+                self.register.add_character(name, self.symbol(glyph)[self.theme_display])
+                characters.append(self.register.get_escape_code(name))
+        return "".join(characters)
+
+    def stdout_text(self, glyphs):
+        """Turns a glyph sequence into text for stdout."""
+        characters = []
+        for glyph in glyphs:
+            if glyph < glyph_base:
+                characters.append(chr(glyph))
+            else:
+                characters.append(self.symbol(glyph)[self.theme_stdout])
+        return "".join(characters)
+
+class display_manager(object):
+    """Drives several UIs, each with its own display, from one process. Frames of all UIs are scheduled together.
+    Displays on different buses are flushed in parallel on a thread pool, while displays that share a bus are flushed
+    one after the other, as a bus can only do one thing at a time. The bus of a display is found with its bus_id
+    function (the char LCD plate has one), or can be given when the UI is added; displays without a bus get a
+    thread of their own.
+    The manager keeps the frame latency of every display: the time from the start of a frame until that display was
+    flushed."""
+    def __init__(self, max_workers=None, latency_window=64):
+        self.uis = collections.OrderedDict()
+        self.buses = {}
+        self.latencies = {}
+        self.latency_window = latency_window
+        self.max_workers = max_workers
+        self.executor = None
+        self.lock = threading.RLock()
+        self.render_thread = None
+        self.render_stop = threading.Event()
+        self.dropped_frames = 0
+        self.frames = 0
+
+    def add(self, ui, name=None, bus=None):
+        """Adds a UI under a name (by default, a number). Returns the name."""
+        with self.lock:
+            if name is None:
+                name = len(self.uis)
+            if bus is None:
+                bus_id = getattr(ui.display, "bus_id", None)
+                bus = bus_id() if bus_id is not None else ("display", name)
+            self.uis[name] = ui
+            self.buses[name] = bus
+            self.latencies[name] = collections.deque(maxlen=self.latency_window)
+            return name
+
+    def remove(self, name):
+        """Removes a UI. Returns False if there is no UI by that name."""
+        with self.lock:
+            if name not in self.uis:
+                return False
+            del self.uis[name]
+            del self.buses[name]
+            del self.latencies[name]
+            return True
+
+    def get_ui(self, name):
+        return self.uis[name]
+
+    def bus_groups(self):
+        """Returns the names of the UIs grouped by bus, as a list of lists."""
+        groups = collections.OrderedDict()
+        for name in self.uis:
+            groups.setdefault(self.buses[name], []).append(name)
+        return [group for group in groups.values()]
+
+    def redraw(self):
+        """Redraws all UIs. Returns when every display has been flushed."""
+        with self.lock:
+            start = time.time()
+            groups = self.bus_groups()
+            if len(groups) == 1:
+                self.redraw_group(groups[0], start)
+            else:
+                if self.executor is None:
+                    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+                futures = [self.executor.submit(self.redraw_group, group, start) for group in groups]
+                for future in futures:
+                    future.result()
+            self.frames += 1
+
+    def redraw_group(self, names, start):
+        """Redraws the UIs of one bus, one after the other."""
+        for name in names:
+            ui = self.uis[name]
+            try:
+                ui.redraw()
+            except Exception as e:
+                ui.log("Render error: %s" % e)
+            self.latencies[name].append(time.time() - start)
+
+    def start(self, fps=10):
+        """Starts redrawing all UIs on a render thread, at a fixed number of frames per second."""
+        if self.render_thread is not None:
+            return
+        self.render_stop.clear()
+        self.render_thread = threading.Thread(target=self.render_loop, args=(fps,), name="libLCDUI displays")
+        self.render_thread.daemon = True
+        self.render_thread.start()
+
+    def stop(self):
+        """Stops the render thread, after it has finished the frame it is drawing, and the thread pool."""
+        if self.render_thread is not None:
+            self.render_stop.set()
+            self.render_thread.join()
+            self.render_thread = None
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def render_loop(self, fps):
+        """Main loop of the render thread. Like the render thread of a single UI, it drops frames it can't draw in
+        time."""
+        period = 1.0 / fps
+        next_frame = time.time()
+        while not self.render_stop.is_set():
+            self.redraw()
+            now = time.time()
+            next_frame, missed = schedule_frame(next_frame, period, now)
+            self.dropped_frames += missed
+            self.render_stop.wait(next_frame - now)
+
+    def latency(self, name, percent=50):
+        """Returns a percentile of the frame latency of a display over the last frames, in seconds, or None if it
+        hasn't been drawn yet."""
+        return percentile(self.latencies[name], percent)
+
+    def stats(self, percentiles=(50, 90, 99)):
+        """Returns the frame latency of every display, and the number of frames drawn and dropped, as a
+        dictionary."""
+        with self.lock:
+            displays = {}
+            for name in self.uis:
+                displays[name] = {"bus": repr(self.buses[name]),
+                                  "last_latency": self.latencies[name][-1] if self.latencies[name] else None}
+                for percent in percentiles:
+                    displays[name]["p%s" % percent] = self.latency(name, percent)
+            return {"frames": self.frames, "dropped_frames": self.dropped_frames, "displays": displays}
 
 class LCDUI_widget(object):
     """Base object for all LCDUI widgets. Do not call this directly.
@@ -275,6 +1575,18 @@ class LCDUI_widget(object):
         self.name = name
         self.rjust = False
         self.center = False
+        self.word_wrap = False
+        self.layout_key = None
+        self.source = None
+        self.version = 0
+        self.changed_at = None
+
+    def mark_changed(self):
+        """Bumps the version of the widget. The UI object compares versions to find out which widgets have to be
+        composed again, so every function that changes what the widget looks like should call this."""
+        self.version += 1
+        if self.changed_at is None:
+            self.changed_at = time.time()
 
     def set_name(self, name):
         """Sets the name of the widget. Names are not required, but may make managing larger projects easier. The names
@@ -297,11 +1609,15 @@ class LCDUI_widget(object):
     def show(self):
         """Shows (unhides) the widget. This does not guarantee that the widget is visible, as other widgets may be on
         top."""
-        self.visible = True
+        if not self.visible:
+            self.visible = True
+            self.mark_changed()
 
     def hide(self):
         """Hides the widget by not drawing it to the buffer."""
-        self.visible = False
+        if self.visible:
+            self.visible = False
+            self.mark_changed()
 
     def write(self, message):
         """Writes information to the widget for display on the LCD. The widget manages what to do with the
@@ -309,43 +1625,42 @@ class LCDUI_widget(object):
         value.
         There are two ways to use this function. If you write one single string, the widget makes sure to wrap the
         lines if necessary. If you write several lines by calling the function with a list, the function writes each
-        line to a new line, if the height of the widget permits as many lines."""
-        self.contents = []
-        if type(message) is str:
-            stripped_of_special_characters = re.sub("\[(.*?)\]", "", message)
-            message_left_to_process = stripped_of_special_characters
-            special_characters = re.findall("\[(.*?)\]", message)
-            characters_matched = 0
-            for n in range(self.height):
-                line_to_write = ""
-                snippet = message_left_to_process[0:self.width]
-                for c in snippet:
-                    if c == "~":
-                        if characters_matched >= len(special_characters):
-                            break  # This happens if a closing bracket was not found in the message
-                        c += "[%s]" % special_characters[characters_matched]
-                        characters_matched += 1
-                    line_to_write += c
-                width_correction = len(line_to_write) - len(snippet)
-                if self.rjust:
-                    self.contents.append(line_to_write.rjust(self.width + width_correction, " ", ))
-                elif self.center:
-                    self.contents.append(line_to_write.center(self.width + width_correction, " "))
-                else:
-                    self.contents.append(line_to_write.ljust(self.width + width_correction, " "))
-                message_left_to_process = message_left_to_process[self.width:]
-        elif type(message) is int or type(message) is float:
-            self.contents=[str(message)]
-        else:
-            for n in range(min(self.height, len(message))):
-                if self.rjust:
-                    self.contents.append(str(message[n]).rjust(self.width, " "))
-                elif self.center:
-                    self.contents.append(str(message[n]).center(self.width, " "))
-                else:
-                    self.contents.append(str(message[n]).ljust(self.width, " "))
+        line to a new line, if the height of the widget permits as many lines.
+        Writing the same message again changes nothing, so it is fine to write every time through the main loop."""
+        key = layouts.key(message, self.width, self.height, self.justification(), self.word_wrap)
+        if key is not None and key == self.layout_key:
+            return self.contents
+        self.raw_message = message
+        self.layout_key = key
+        self.relayout()
         return self.contents
 
+    def relayout(self):
+        """Lays out the last message written again, after the justification or wrapping changed."""
+        # The contents are built aside and then replaced at once, so a render thread never sees half-written contents.
+        self.contents = [line for line in layouts.layout(self.raw_message, self.width, self.height, self.justification(),
+                                                         self.word_wrap, self.layout_key)]
+        self.mark_changed()
+
+    def justification(self):
+        """Returns the text justification of the widget: libLCDUI.left, .right or .center."""
+        if self.rjust:
+            return right
+        elif self.center:
+            return center
+        return left
+
+    def justify(self, glyphs):
+        """Pads a glyph sequence to the width of the widget, according to the text justification."""
+        return layouts.justify(glyphs, self.width, self.justification())
+
+    def set_word_wrap(self, word_wrap=True):
+        """Wraps text written as a single string at spaces instead of at the width of the widget."""
+        self.word_wrap = word_wrap
+        if self.raw_message is not None:
+            self.layout_key = layouts.key(self.raw_message, self.width, self.height, self.justification(), word_wrap)
+            self.relayout()
+
     def format(self, option):
         """Sets text justification. You can pass libLCDUI.left, .right or .center to justify text."""
         if option == left:
@@ -357,12 +1672,66 @@ class LCDUI_widget(object):
         elif option == right:
             self.rjust = True
             self.center = False
+        if self.raw_message is not None:
+            self.layout_key = layouts.key(self.raw_message, self.width, self.height, self.justification(),
+                                          self.word_wrap)
+            self.relayout()
+        else:
+            self.mark_changed()
+
+    def update(self, now):
+        """Called by the UI at the start of every frame, with the time of the frame. Widgets that change by themselves,
+        like scrolling text, change their contents here."""
+        self.check_timeout()
+        self.pull(now)
+
+    def bind(self, source, refresh_interval=0, format=None):
+        """Binds the widget to a source: a function that returns the value to show. The UI calls the source when it
+        draws a frame, but only while the widget is visible and at most once every refresh_interval seconds, so there
+        is no need to write the widget from the main loop. The value is passed to format first, if given, and then
+        written to the widget, unless it is the same value as last time. A list is compared by its items, so a source
+        may return the same list after changing it in place; other values that can change in place (like dictionaries)
+        have to be returned as a new object when they change."""
+        self.source = source
+        self.refresh_interval = refresh_interval
+        self.source_format = format
+        self.last_pull = None
+        self.has_value = False
+        self.bound_value = None
+
+    def unbind(self):
+        """Stops pulling values from the source of the widget. The last value stays on the widget."""
+        self.source = None
+
+    def pull(self, now):
+        """Pulls a new value from the source of the widget, if it is bound, visible and due."""
+        if self.source is None or not self.visible:
+            return
+        if self.last_pull is not None and now - self.last_pull < self.refresh_interval:
+            return
+        self.last_pull = now
+        value = self.source()
+        # A copy of the items of a list is kept, because the source may change the list itself.
+        snapshot = tuple(value) if type(value) is type([]) else value
+        if self.has_value and snapshot == self.bound_value:
+            return
+        self.has_value = True
+        self.bound_value = snapshot
+        self.write_value(self.source_format(value) if self.source_format is not None else value)
+
+    def write_value(self, value):
+        """Writes a value from the source of the widget."""
+        self.write(value)
+
+    def check_timeout(self):
+        """Hides the widget if its countdown has expired."""
+        if not(self.timeout == 0) and (time.time() - self.creationTime) > self.timeout:
+            self.hide()
 
     def get_contents(self):
         """This function is used by the UI object to obtain the contents of a widget. This function also checks to see
         if the timeout of a widget has expired. Expired functions are then automatically hidden."""
-        if not(self.timeout == 0) and (time.time() - self.creationTime) > self.timeout:
-            self.hide()
+        self.check_timeout()
         if self.visible:
             return self.contents
         else:
@@ -370,40 +1739,95 @@ class LCDUI_widget(object):
 
 class scrolltext(LCDUI_widget):
     """A scrolltext is a single text widget. If the line written to this widget is wider than the widget width, the text
-    will scroll."""
+    will scroll. The scrolling is driven by the UI: once a line is written, it scrolls by itself, without writing it
+    again. Every position of the line is prepared when it is written, in a ring of frames that starts with the pause
+    before scrolling, so moving the text costs no more than picking the frame for the current time."""
     def __init__(self, width, height, name="<name not defined>"):
         super(scrolltext, self).__init__(self, width, height, name)
-        self.contents = ""
+        self.contents = []
         self.scroll_speed = 0.5
         self.pause_before_scroll = 5
-        self.scroll_timer = time.time()
-        self.pause_timer = time.time()
-        self.scroll_position = 0
+        self.message = None
+        self.ring = ()
+        self.ring_offsets = ()
+        self.strip = None
+        self.ring_start = time.time()
+        self.ring_position = 0
+        self.updates = 0
 
     def set_scroll_speed(self, scroll_speed):
-        """Sets the speed by which the text scrolls by in jumps per second."""
+        """Sets the time (in seconds) between two jumps of the text. With a speed of 0, the text jumps every frame, and
+        doesn't pause."""
         self.scroll_speed = scroll_speed
+        self.make_ring()
 
     def set_scroll_pause(self, scroll_pause):
         """Sets the time to display the start of the line before the widget starts scrolling."""
         self.pause_before_scroll = scroll_pause
+        self.make_ring()
 
     def write(self, message):
-        """Sets the single text line to display inm the widget. The line may be longer than the widget width."""
-        if time.time() - self.pause_timer > self.pause_before_scroll:
-            if time.time() - self.scroll_timer > self.scroll_speed:
-                discarded_part = message[0:self.scroll_position]
-                if "~" in discarded_part:
-                    self.scroll_position = message.index["]"]
-                if self.scroll_position > len(re.sub("\[(.*?)\]", "", message))-(self.width/2):
-                    self.scroll_position = 0
-                    self.pause_timer = time.time()
-                super(scrolltext, self).write(message[self.scroll_position:])
-                self.scroll_position += 1
-                self.scroll_timer = time.time()
-        else:
-            super(scrolltext, self).write(message)
+        """Sets the single text line to display in the widget. The line may be longer than the widget width. Writing
+        the line that is already scrolling doesn't restart it."""
+        if message != self.message:
+            self.message = message
+            self.make_ring()
+        return self.contents
 
+    def format(self, option):
+        """Sets text justification, and prepares the frames of the line again."""
+        super(scrolltext, self).format(option)
+        self.make_ring()
+
+    def set_word_wrap(self, word_wrap=True):
+        """Sets word wrapping, and prepares the frames of the line again."""
+        super(scrolltext, self).set_word_wrap(word_wrap)
+        self.make_ring()
+
+    def make_ring(self):
+        """Prepares the frames of the scrolling line, and starts scrolling from the start of the line. The line scrolls
+        until half of the widget is empty, and then starts over."""
+        if self.message is None:
+            return
+        glyphs = tokenizer.tokenize(str(self.message))
+        windows = [self.justify(glyphs[:self.width])]
+        offsets = [0]
+        if len(glyphs) > self.width:
+            for position in range(1, int(len(glyphs) - self.width / 2.0) + 1):
+                windows.append(self.justify(glyphs[position:position + self.width]))
+                offsets.append(position)
+            if self.scroll_speed > 0:
+                # The pause frames all refer to the first window.
+                pause_frames = int(math.ceil(self.pause_before_scroll / float(self.scroll_speed)))
+                windows = windows[:1] * pause_frames + windows
+                offsets = offsets[:1] * pause_frames + offsets
+        # The complete line, in which every window can be found at its offset, for scrolling by shifting the display.
+        self.strip = self.justify(glyphs + (space,) * (offsets[-1] + self.width - len(glyphs)))
+        if len(offsets) == 1 or any(self.strip[offset:offset + self.width] != window
+                                    for offset, window in zip(offsets, windows)):
+            self.strip = None
+        self.ring_offsets = tuple(offsets)
+        self.ring = tuple(windows)
+        self.ring_start = time.time()
+        self.ring_position = 0
+        self.updates = 0
+        self.contents = [self.ring[0]]
+        self.mark_changed()
+
+    def update(self, now):
+        """Shows the frame of the ring for the time of the frame."""
+        super(scrolltext, self).update(now)
+        if not self.ring:
+            return
+        if self.scroll_speed > 0:
+            position = int((now - self.ring_start) / self.scroll_speed) % len(self.ring)
+        else:
+            position = self.updates % len(self.ring)
+            self.updates += 1
+        if position != self.ring_position:
+            self.ring_position = position
+            self.contents = [self.ring[position]]
+            self.mark_changed()
 
 
 class text(LCDUI_widget):
@@ -424,13 +1848,31 @@ class notify(LCDUI_widget):
         self.timeout = timeout
         self.creationTime = time.time()
 
+class item_provider(object):
+    """A sequence of list items that are fetched when they are needed: fetch(index) returns the item at an index. Pass
+    it to list.set_items, or use list.set_provider."""
+    def __init__(self, length, fetch):
+        self.length = length
+        self.fetch = fetch
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.length:
+            raise IndexError("list item %s out of range" % index)
+        return self.fetch(index)
+
 class list(LCDUI_widget):
     """Users can select options from lists. The list may be longer than the number of showable lines.
     You can write all options at once, clearing the list first. Or you can appende new options with the add_item function.
     Call move_up and move_down to move the list indicator, to make the widget respond to input. The function get_selected
-    returns the currently selected item, either by name or by number."""
+    returns the currently selected item, either by name or by number.
+    Long lists don't have to be in memory: set_items takes any sequence, and set_provider a length and a function that
+    fetches an item. Only the visible items are fetched, and the most recently shown rows are kept in a cache of
+    limited size, so jumping anywhere in the list costs the same."""
 
-    def __init__(self, width, height, name="<name not defined>"):
+    def __init__(self, width, height, name="<name not defined>", cache_size=256):
         super(list, self).__init__(self, width, height, name)
         self.contents = []
         self.items = []
@@ -438,76 +1880,152 @@ class list(LCDUI_widget):
         self.top_item = 0
         self.selected = "~[RIGHT]"
         self.not_selected = " "
+        self.row_cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.search_keys = None
+        self.search_indices = None
+        self.search_prefix = ""
 
     def set_indicator(self, selected, not_selected =" "):
         self.selected = selected
         self.not_selected = not_selected
+        self.make_contents()
 
     def clear(self):
         """Clears the options list."""
-        self.contents = []
-        self.items = []
+        self.set_items([])
+
+    def write(self, *args):
+        """Adds a list of several items at once, first clearing the list. The selection is kept, as far as the new
+        items allow. Writing the same items again changes nothing, so it is fine to write every time through the main
+        loop."""
+        items = [str(lines)[0:self.width] for lines in args]
+        if items == self.items:
+            return
+        self.items = items
+        self.items_changed()
+
+    def set_items(self, items):
+        """Shows a sequence of items, starting at the top. The sequence is not copied: items are fetched from it when
+        they are shown. Call items_changed if the sequence changes afterwards."""
+        self.items = items
         self.listindex = 0
         self.top_item = 0
+        self.items_changed()
 
-    def write(self, *args):
-        """Adds a list of several items at once, first clearing the list."""
-        self.items = []
-        for lines in args:
-            self.items.append(str(lines)[0:self.width])
-        #self.start_countdown(timeout)
-        self.make_contents()
+    def write_value(self, value):
+        """Shows a sequence of items from the source of the widget. The selection is kept, as far as the new items
+        allow."""
+        self.items = value
+        self.items_changed()
+
+    def set_provider(self, length, fetch):
+        """Shows length items that are fetched by calling fetch(index) when they are shown."""
+        self.set_items(item_provider(length, fetch))
 
     def add_item(self, *args):
         """Append an item to the bottom of the list."""
+        if type(self.items) is not type([]):
+            raise ValueError("Items can only be added to a list widget that holds its own items")
         for line in args:
             self.items.append(line)
+        self.items_changed()
+
+    def items_changed(self):
+        """Forgets the cached rows and the search index, after the items changed."""
+        self.row_cache.clear()
+        self.search_keys = None
+        self.search_indices = None
+        self.search_prefix = ""
+        self.listindex = max(0, min(self.listindex, len(self.items) - 1))
+        self.top_item = max(0, min(self.top_item, self.listindex, len(self.items) - self.height))
         self.make_contents()
 
+    def item_glyphs(self, index):
+        """Returns the glyphs of an item, from the cache if it was shown recently."""
+        if index in self.row_cache:
+            glyphs = self.row_cache.pop(index)
+        else:
+            glyphs = tokenizer.tokenize(str(self.items[index]))
+            if len(self.row_cache) >= self.cache_size:
+                # Forget the row that was shown least recently.
+                self.row_cache.popitem(last=False)
+        self.row_cache[index] = glyphs
+        return glyphs
+
     def make_contents(self):
         """This creates the contents based on the currently viewable part of the list. For internal use in this
         class."""
-        self.contents = []
-        for i in range(min(len(self.items), self.height)):
-            self.contents.append(self.items[self.top_item + i])
-        for i, line in enumerate(self.contents):
+        contents = []
+        for i in range(min(len(self.items) - self.top_item, self.height)):
             if i == self.listindex - self.top_item:
-                self.contents[i] = self.selected + line
+                indicator = self.selected
             else:
-                self.contents[i] = self.not_selected + line
+                indicator = self.not_selected
+            contents.append(tokenizer.tokenize(indicator) + self.item_glyphs(self.top_item + i))
+        self.contents = contents
+        self.mark_changed()
 
     def move_down(self, steps=1):
         """Move the indicator down one or more steps. Usually, this function is called in response to a button press."""
-        self.listindex += steps
-        if self.listindex >= len(self.items):
-            self.listindex = len(self.items)-1
-            #self.listindex = 0
-            #self.top_item = 0
-        if self.listindex - self.top_item >= self.height:
-            self.top_item += steps
-        self.make_contents()
+        self.set_listindex(self.listindex + steps)
 
     def move_up(self, steps=1):
         """Move the indicator up one or more steps. Usually, this function is called in response to a button press."""
-        self.listindex -= steps
-        if self.listindex < 0:
-            self.listindex = 0
-            #self.listindex = len(self.items) - 1
-            #self.top_item = len(self.items) - self.height
-        if self.listindex - self.top_item < 0:
-            self.top_item -= steps
-        self.make_contents()
+        self.set_listindex(self.listindex - steps)
+
+    def page_down(self):
+        """Move the indicator down by the height of the widget."""
+        self.set_listindex(self.listindex + self.height)
+
+    def page_up(self):
+        """Move the indicator up by the height of the widget."""
+        self.set_listindex(self.listindex - self.height)
 
     def set_listindex(self, index):
-        if not self.listindex == -1:
-            if index > self.listindex:
-                #print "index %s, listindex %s" % (index, self.listindex)
-                self.move_down()
-                self.set_listindex(index)
-            elif index < self.listindex:
-                #print "index %s, listindex %s" % (index, self.listindex)
-                self.move_up()
-                self.set_listindex(index)
+        """Moves the indicator to an item. The list scrolls as little as possible to show it."""
+        index = max(0, min(index, len(self.items) - 1))
+        top_item = self.top_item
+        if index < top_item:
+            top_item = index
+        elif index >= top_item + self.height:
+            top_item = index - self.height + 1
+        top_item = max(0, min(top_item, len(self.items) - self.height))
+        if index != self.listindex or top_item != self.top_item:
+            self.listindex = index
+            self.top_item = top_item
+            self.make_contents()
+
+    def build_search_index(self):
+        """Builds the index used by find and search. This fetches every item once; it is done automatically on the
+        first search."""
+        keys = sorted((str(self.items[index]).lower(), index) for index in range(len(self.items)))
+        self.search_keys = [key for key, index in keys]
+        self.search_indices = [index for key, index in keys]
+
+    def find(self, prefix):
+        """Returns the index of the item that starts with prefix (ignoring case) and comes first alphabetically, or
+        None if there is none."""
+        if self.search_keys is None:
+            self.build_search_index()
+        prefix = prefix.lower()
+        n = bisect.bisect_left(self.search_keys, prefix)
+        if n < len(self.search_keys) and self.search_keys[n].startswith(prefix):
+            return self.search_indices[n]
+        return None
+
+    def search(self, text):
+        """Adds text to the search prefix, as typed, and moves the indicator to the first item that starts with the
+        prefix. Returns the index of that item, or None if no item matches (the indicator then stays where it is)."""
+        self.search_prefix += text
+        index = self.find(self.search_prefix)
+        if index is not None:
+            self.set_listindex(index)
+        return index
+
+    def reset_search(self):
+        """Starts a new search."""
+        self.search_prefix = ""
 
     def get_selected(self, by_name = False):
         """This returns the currently selected item from the list, either by number (default) or by name.
@@ -528,17 +2046,15 @@ class list(LCDUI_widget):
     def get_contents(self):
         """This function is used by the UI object to obtain the contents of a widget. This overrides the standard
         get_contents of the parent object because not all items are viewable in list objects."""
-        if not(self.timeout == 0) and (time.time() - self.creationTime) > self.timeout:
-            self.hide()
+        self.check_timeout()
         if self.visible:
-            for i, line in enumerate(self.contents):
-                self.contents[i] = line #[:self.width].ljust(self.width, " ")
-                if i >= self.height:
-                    break
             return self.contents
         else:
             return ""
 
+# Rows of every state of the progress bars, shared by all bars that look the same. See generic_progress_bar.table.
+progress_bar_tables = {}
+
 class generic_progress_bar(LCDUI_widget):
     """A progressbar converts a value relative to a maximum value into a number of similar characters.
     The function does not support half-full characters yet."""
@@ -550,6 +2066,7 @@ class generic_progress_bar(LCDUI_widget):
         self.max_value = max_value
         self.horizontal_orientation = horizontal_orientation
         self.position_only = position_only
+        self.state = None
         if self.position_only and self.horizontal_orientation:
             self.char_before_marker = "~[PB_HORI_NONE]"
             self.char_after_marker = "~[PB_HORI_NONE]"
@@ -587,29 +2104,63 @@ class generic_progress_bar(LCDUI_widget):
         self.max_value = maximum_value
         if self.current_value > self.max_value:
             self.current_value = self.max_value
+        self.write(self.current_value)
 
     def write(self, current_value):
+        """Sets the value of the bar. The value is quantized to the cells of the bar: the number of filled cells and the
+        part of the marker cell. If that doesn't change, nothing else is done."""
         self.current_value = current_value
-        self.contents = []
+        state = self.quantize(current_value)
+        if state == self.state:
+            return
+        self.state = state
+        self.contents = [row for row in self.table()[state]]
+        self.mark_changed()
+
+    def size(self):
+        """Returns the number of cells along the bar."""
         if self.horizontal_orientation:
-            size = self.width
-        else:
-            size = self.height
-        fraction = min(self.current_value, self.max_value) / float(self.max_value)
+            return self.width
+        return self.height
+
+    def quantize(self, value):
+        """Returns the (fill, part) state of the bar for a value."""
+        size = self.size()
+        fraction = min(max(value / float(self.max_value), 0.0), 1.0)
         fill = int(fraction * size)
         part = int((fraction * size % 1) * len(self.marker_char))
+        return (fill, part)
+
+    def table(self):
+        """Returns the table of the rows of every state of the bar. Tables are shared between bars that look the
+        same."""
+        markers = tuple(self.marker_char[part] for part in sorted(self.marker_char))
+        key = (self.horizontal_orientation, self.width, self.height, self.char_before_marker, self.char_after_marker,
+               markers)
+        if key not in progress_bar_tables:
+            table = {}
+            for fill in range(self.size() + 1):
+                for part in range(len(markers)):
+                    table[(fill, part)] = self.render(fill, markers[part])
+            progress_bar_tables[key] = table
+        return progress_bar_tables[key]
+
+    def render(self, fill, marker):
+        """Returns the rows of the bar with fill cells filled and the marker in the next cell, as glyph tuples."""
+        contents = []
         if self.horizontal_orientation:
             for n in range(self.height):
-                self.contents.append((self.char_before_marker * fill) + self.marker_char[part] +
-                                     (self.char_after_marker * (self.width - fill - 1)))
+                contents.append(tokenizer.tokenize((self.char_before_marker * fill) + marker +
+                                                   (self.char_after_marker * (self.width - fill - 1))))
         else:  # Vertical orientation
             for n in range(self.height):
                 if n == (self.height - fill - 1):
-                    self.contents.append(self.marker_char[part] * self.width)
+                    contents.append(tokenizer.tokenize(marker * self.width))
                 elif n < (self.height - fill - 1):
-                    self.contents.append(self.char_after_marker * self.width)
+                    contents.append(tokenizer.tokenize(self.char_after_marker * self.width))
                 elif n > (self.height - fill - 1):
-                    self.contents.append(self.char_before_marker * self.width)
+                    contents.append(tokenizer.tokenize(self.char_before_marker * self.width))
+        return tuple(contents)
 
 class vertical_progress_bar(generic_progress_bar):
     """A vertical progress bar that fills up."""
@@ -0,0 +1,359 @@
+#!/usr/bin/python
+"""Benchmarks for libLCDUI that need no hardware.
+
+Scripted scenarios, modeled on the example scripts, drive a ui object that draws to a real Adafruit_CharLCD object.
+The display is connected to a fake GPIO (or, for the char LCD plate, to a RecordingI2C bus) that counts every bus
+transaction, and timed by a simulated clock, so the time the display would need is estimated from the HD44780 timing
+model without waiting for it. The results are written as JSON, so they can be compared between versions:
+
+    python -m libLCDUI_bench
+    python -m libLCDUI_bench --frames 500 --timing datasheet --output results.json
+
+The Adafruit_GPIO package is still needed for its constants and the MCP23017 class, but no hardware is used."""
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+import libLCDUI
+import Adafruit_CharLCD
+
+timings = {"safe": Adafruit_CharLCD.HD44780_SAFE_TIMING,
+           "datasheet": Adafruit_CharLCD.HD44780_DATASHEET_TIMING}
+
+
+class simulated_clock(object):
+    """A TimingEngine that doesn't wait, but moves its own clock forward instead. The clock then shows how long the
+    display would have kept the program busy."""
+    def __init__(self):
+        self.time = 0.0
+        self.waits = 0
+        self.skipped = 0
+        self.slept = 0
+
+    def now(self):
+        return self.time
+
+    def wait_until(self, deadline):
+        if deadline <= self.time:
+            self.skipped += 1
+        else:
+            self.waits += 1
+            self.time = deadline
+
+    def delay_microseconds(self, microseconds):
+        if microseconds > 0:
+            self.wait_until(self.time + microseconds / 1000000.0)
+
+    def advance(self, seconds):
+        """Moves the clock forward, for time spent on the bus."""
+        self.time += seconds
+
+
+class counting_gpio(object):
+    """Fake GPIO for Adafruit_CharLCD. Every call that changes pins counts as one bus transaction, which takes
+    call_us microseconds on the simulated clock."""
+    def __init__(self, clock, call_us=2):
+        self.clock = clock
+        self.call_us = call_us
+        self.transactions = 0
+
+    def setup(self, pin, mode, pull_up_down=None):
+        pass
+
+    def output(self, pin, value):
+        self.transactions += 1
+        self.clock.advance(self.call_us / 1000000.0)
+
+    def output_pins(self, pins):
+        self.transactions += 1
+        self.clock.advance(self.call_us / 1000000.0)
+
+
+class timed_i2c(Adafruit_CharLCD.RecordingI2C):
+    """A RecordingI2C bus of which every transaction takes time on the simulated clock: 9 bit times for every byte,
+    including the address and register bytes."""
+    def __init__(self, clock, bus_speed_khz=400):
+        super(timed_i2c, self).__init__()
+        self.clock = clock
+        self.bus_speed_khz = bus_speed_khz
+
+    def get_i2c_device(self, address, busnum=None, **kwargs):
+        device = timed_i2c_device(self, address, busnum)
+        self.devices.append(device)
+        return device
+
+
+class timed_i2c_device(Adafruit_CharLCD.RecordingI2CDevice):
+    def _record(self, operation, register, data):
+        super(timed_i2c_device, self)._record(operation, register, data)
+        self._bus.clock.advance((len(data) + 2) * 9 / (self._bus.bus_speed_khz * 1000.0))
+
+
+class counter(object):
+    """Counts the calls to the display functions the UI uses, and the bytes that are sent to the display controller.
+    A byte is counted once, whether it is sent by write8 or by write_bytes, also when one calls the other."""
+    counted_calls = ("set_cursor", "message", "create_char", "create_chars", "clear")
+
+    def __init__(self, display):
+        self.display = display
+        self.calls = dict((name, 0) for name in self.counted_calls)
+        self.bytes = 0
+        self.depth = 0
+        for name in self.counted_calls:
+            setattr(display, name, self.count_call(name, getattr(display, name)))
+        display.write8 = self.count_bytes(display.write8, lambda args: 1)
+        display.write_bytes = self.count_bytes(display.write_bytes, lambda args: len(args[0]))
+
+    def count_call(self, name, function):
+        def counted(*args, **kwargs):
+            self.calls[name] += 1
+            return function(*args, **kwargs)
+        return counted
+
+    def count_bytes(self, function, size):
+        def counted(*args, **kwargs):
+            if self.depth == 0:
+                self.bytes += size(args)
+            self.depth += 1
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.depth -= 1
+        return counted
+
+
+def gpio_backend(timing, width, height):
+    """A display on GPIO pins, as with Adafruit_CharLCD on a Raspberry Pi."""
+    clock = simulated_clock()
+    gpio = counting_gpio(clock)
+    display = Adafruit_CharLCD.Adafruit_CharLCD(27, 22, 25, 24, 23, 18, width, height, gpio=gpio, timing=timing,
+                                                timing_engine=clock)
+    return display, clock, lambda: (gpio.transactions, 0)
+
+
+def plate_backend(timing, width, height):
+    """A char LCD plate, with the display behind an MCP23017 on the I2C bus."""
+    clock = simulated_clock()
+    bus = timed_i2c(clock)
+    display = Adafruit_CharLCD.Adafruit_CharLCDPlate(cols=width, lines=height, timing=timing, timing_engine=clock,
+                                                     i2c=bus)
+    return display, clock, lambda: (len(bus.transactions), bus.bytes_transferred())
+
+backends = {"gpio": gpio_backend, "plate": plate_backend}
+
+
+def counter_scenario(ui, frames):
+    """Modeled on example_stdout_1: a message, a counter and a progress bar that change every frame."""
+    message = libLCDUI.text(10, 3)
+    count = libLCDUI.text(6, 2)
+    progress = libLCDUI.horizontal_progress_bar(16, 1, 0, 16)
+    ui.add_widget(progress, 3, 0)
+    ui.add_widget(message, 0, 0)
+    ui.add_widget(count, 0, 10)
+    for i in range(frames):
+        message.write("Key: %s" % "udg"[i % 3])
+        count.write("Count:%s" % (i % 100))
+        progress.write(i % 17)
+        yield
+
+def menu_scenario(ui, frames):
+    """Modeled on example_stdout_2: moving through a short menu, with a status line and a position bar."""
+    status = libLCDUI.text(18, 1)
+    menu = libLCDUI.list(18, 3)
+    menu.write("Option 1", "Option 2", "Option 3", "Option 4", "Option 5", "Final option")
+    menu.add_item("Really final")
+    position = libLCDUI.vertical_position_bar(1, 4, 0, menu.get_number_of_items())
+    ui.add_widget(status, 3, 0)
+    ui.add_widget(menu, 0, 0)
+    ui.add_widget(position, 0, 19)
+    for i in range(frames):
+        if (i // menu.get_number_of_items()) % 2 == 0:
+            menu.move_down()
+            key = "d"
+        else:
+            menu.move_up()
+            key = "u"
+        status.write("U(p) D(own) G(et):%s" % key)
+        position.write(menu.get_selected())
+        yield
+
+def plate_demo_scenario(ui, frames):
+    """Modeled on example_lcd: a volume bar, a changing value and a scrolling list, with widgets that are hidden and
+    shown again."""
+    message = libLCDUI.text(6, 1)
+    progress = libLCDUI.horizontal_position_bar(8, 1, 0, 50)
+    volume = libLCDUI.vertical_position_bar(1, 2, 0, 50)
+    alert = libLCDUI.text(3, 2)
+    items = libLCDUI.list(10, 2)
+    message.write("Test ~[NOTE]")
+    items.write("Option 1", "Option 2", "Option 3", "Option 4", "Option 5")
+    items.set_indicator("~[RIGHT_SMALL]")
+    ui.add_widget(volume, 0, 0)
+    ui.add_widget(alert, 0, 1)
+    ui.add_widget(items, 0, 4)
+    ui.add_widget(message, 0, 10)
+    ui.add_widget(progress, 1, 8)
+    v = 0
+    for i in range(frames):
+        v += 1
+        if v > 40:
+            progress.hide()
+            message.hide()
+        if v > 50:
+            v = 0
+            progress.show()
+            message.show()
+        progress.write(v)
+        alert.write(["V=", v])
+        volume.write(v)
+        if (i // 4) % 2 == 0:
+            items.move_down()
+        else:
+            items.move_up()
+        yield
+
+def scroll_scenario(ui, frames):
+    """A line of text that is too long for the display scrolls by one position every frame."""
+    title = libLCDUI.text(16, 1)
+    line = libLCDUI.scrolltext(16, 1)
+    line.set_scroll_pause(0)
+    line.set_scroll_speed(0)
+    title.write("Now playing")
+    ui.add_widget(title, 0, 0)
+    ui.add_widget(line, 1, 0)
+    for i in range(frames):
+        line.write("A rather long song title by an artist with an even longer name")
+        yield
+
+def marquee_scenario(ui, frames):
+    """A full-width ticker on an otherwise empty display, scrolled by shifting the display."""
+    ui.set_hardware_scroll(True)
+    line = libLCDUI.scrolltext(16, 1)
+    line.set_scroll_pause(0)
+    line.set_scroll_speed(0)
+    ui.add_widget(line, 0, 0)
+    line.write("Artist ~[NOTE] - Song title")
+    for i in range(frames):
+        yield
+
+def long_list_scenario(ui, frames):
+    """Scrolling through a list of a thousand items."""
+    items = libLCDUI.list(19, 4)
+    items.write(*["Item %s" % n for n in range(1000)])
+    position = libLCDUI.vertical_position_bar(1, 4, 0, 1000)
+    ui.add_widget(items, 0, 0)
+    ui.add_widget(position, 0, 19)
+    for i in range(frames):
+        items.move_down()
+        position.write(items.get_selected())
+        yield
+
+def notification_scenario(ui, frames):
+    """A notification pops up over a clock every few frames, and disappears again."""
+    clock = libLCDUI.text(20, 1)
+    body = libLCDUI.text(20, 3)
+    note = libLCDUI.notify(16, 2, timeout=0)
+    clock.format(libLCDUI.center)
+    body.write("Nothing much happens on this screen, until a notification pops up.")
+    note.write(["~[NOTE] New message", "from a friend"])
+    note.hide()
+    ui.add_widget(clock, 0, 0)
+    ui.add_widget(body, 1, 0)
+    ui.add_widget(note, 1, 2)
+    for i in range(frames):
+        clock.write("12:%02d:%02d" % (i // 60 % 60, i % 60))
+        if i % 10 == 0:
+            note.show()
+        elif i % 10 == 5:
+            note.hide()
+        yield
+
+# Scenarios, with the size of the display they use.
+scenarios = {"counter": (counter_scenario, 16, 4),
+             "menu": (menu_scenario, 20, 4),
+             "plate_demo": (plate_demo_scenario, 16, 2),
+             "scroll": (scroll_scenario, 16, 2),
+             "marquee": (marquee_scenario, 16, 2),
+             "long_list": (long_list_scenario, 20, 4),
+             "notification": (notification_scenario, 20, 4)}
+
+
+def run_scenario(name, backend, timing, frames=200, optimize_redraw=True):
+    """Runs one scenario on one backend and returns the results as a dictionary. Times are in microseconds, per
+    frame. Compose time is the time spent composing widgets into the framebuffer, render time is the time spent in
+    redraw (which includes the fake bus), and display time is the estimated time the display would take."""
+    scenario, width, height = scenarios[name]
+    display, clock, bus_totals = backends[backend](timing, width, height)
+    ui = libLCDUI.ui(display, width, height)
+    ui.set_optimize_redraw(optimize_redraw)
+    compose_time = [0.0]
+    compose = ui.compose
+
+    def timed_compose(spans):
+        start = time.perf_counter()
+        composed = compose(spans)
+        compose_time[0] += time.perf_counter() - start
+        return composed
+    ui.compose = timed_compose
+    counts = counter(display)
+    start_transactions, start_bus_bytes = bus_totals()
+    start_clock = clock.now()
+    render_time = 0.0
+    for _ in scenario(ui, frames):
+        start = time.perf_counter()
+        ui.redraw()
+        render_time += time.perf_counter() - start
+    transactions, bus_bytes = bus_totals()
+    display_time = clock.now() - start_clock
+    result = {"scenario": name,
+              "backend": backend,
+              "width": width,
+              "height": height,
+              "frames": frames,
+              "optimize_redraw": optimize_redraw,
+              "compose_us_per_frame": 1e6 * compose_time[0] / frames,
+              "render_us_per_frame": 1e6 * render_time / frames,
+              "display_bytes_per_frame": counts.bytes / float(frames),
+              "bus_transactions_per_frame": (transactions - start_transactions) / float(frames),
+              "bus_bytes_per_frame": (bus_bytes - start_bus_bytes) / float(frames),
+              "estimated_display_us_per_frame": 1e6 * display_time / frames,
+              "estimated_max_fps": frames / display_time if display_time > 0 else None}
+    for call, number in counts.calls.items():
+        result["%s_per_frame" % call] = number / float(frames)
+    return result
+
+def run(frames=200, timing="safe", selected_scenarios=None, selected_backends=None, optimize_redraw=True):
+    """Runs the benchmarks and returns a dictionary with the results of every scenario on every backend."""
+    results = []
+    for name in sorted(selected_scenarios or scenarios):
+        for backend in sorted(selected_backends or backends):
+            results.append(run_scenario(name, backend, timings[timing], frames, optimize_redraw))
+    return {"python": platform.python_version(),
+            "timing": timing,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "results": results}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Hardware-free benchmarks for libLCDUI.")
+    parser.add_argument("--frames", type=int, default=200, help="number of frames per scenario")
+    parser.add_argument("--timing", choices=sorted(timings), default="safe", help="HD44780 timing profile")
+    parser.add_argument("--scenario", action="append", choices=sorted(scenarios),
+                        help="scenario to run (can be repeated; default is all)")
+    parser.add_argument("--backend", action="append", choices=sorted(backends),
+                        help="backend to run on (can be repeated; default is all)")
+    parser.add_argument("--full-rows", action="store_true", help="write full rows instead of planned redraws")
+    parser.add_argument("--output", help="file to write the JSON results to (default is stdout)")
+    args = parser.parse_args(argv)
+    results = run(args.frames, args.timing, args.scenario, args.backend, not args.full_rows)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print("")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+#!/usr/bin/python
+"""Recording and replay of display traffic.
+
+A recording_display can be passed to libLCDUI.ui in place of an Adafruit_CharLCD object. It writes every call to the
+display, with a timestamp, to a compact binary stream file, and passes the call on to the display it wraps (if any).
+The file is written through a small buffer, so the recorder can run for a long time in constant memory; with
+max_bytes, the file is rotated like a log file.
+
+Shifts of the display (move_left and move_right) are recorded too, if the wrapped display supports them.
+
+Recordings are played back into any display with replay, or printed with python -m libLCDUI_recorder <file>.
+
+The stream starts with a header: the magic bytes "LCDR", a format version byte and the start time as a little endian
+double. Every record then starts with an operation byte and the time since the previous record in microseconds (as a
+varint), followed by the arguments of the operation."""
+
+import os
+import struct
+import sys
+import threading
+import time
+
+magic = b"LCDR"
+format_version = 1
+
+# Operations, with the arguments that follow them in the stream.
+op_set_cursor = 1        # column byte, row byte
+op_message = 2           # varint length, text (latin-1)
+op_create_char = 3       # slot byte, 8 bitmap bytes
+op_clear = 4
+op_create_chars = 5      # count byte, and for every character: slot byte, 8 bitmap bytes
+op_home = 6
+op_enable_display = 7    # byte, 0 or 1
+op_set_backlight = 8     # little endian float
+op_set_color = 9         # three little endian floats
+op_move_left = 10
+op_move_right = 11
+
+operation_names = {op_set_cursor: "set_cursor",
+                   op_message: "message",
+                   op_create_char: "create_char",
+                   op_clear: "clear",
+                   op_create_chars: "create_chars",
+                   op_home: "home",
+                   op_enable_display: "enable_display",
+                   op_set_backlight: "set_backlight",
+                   op_set_color: "set_color",
+                   op_move_left: "move_left",
+                   op_move_right: "move_right"}
+
+# Shifts of the display, which the recorder offers only if the display it wraps supports them.
+shift_operations = {"move_left": op_move_left, "move_right": op_move_right}
+
+def encode_varint(value):
+    data = bytearray()
+    while value > 0x7F:
+        data.append((value & 0x7F) | 0x80)
+        value >>= 7
+    data.append(value)
+    return data
+
+
+class recording_display(object):
+    """Records the calls to a display to a stream file, and passes them on to the display it wraps. Without a
+    display, calls are only recorded. Other functions of the wrapped display can be used as usual, but are not
+    recorded.
+
+    The file is flushed to disk every flush_interval seconds (and on close), so only a little of the recording is lost
+    if the program stops unexpectedly. If max_bytes is set, the file is rotated when it gets larger: the recording
+    moves to path.1 (path.1 to path.2, and so on) and a new recording starts, keeping backup_count old files."""
+    def __init__(self, path, display=None, flush_interval=1.0, max_bytes=None, backup_count=3,
+                 buffer_size=4096):
+        self.path = path
+        self.display = display
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.buffer_size = buffer_size
+        self.lock = threading.Lock()
+        self.file = None
+        self.records = 0
+        self.open()
+
+    def open(self):
+        """Starts a new stream file, with its header."""
+        self.file = open(self.path, "wb", self.buffer_size)
+        self.start = time.time()
+        self.last_time = self.start
+        self.last_flush = self.start
+        self.size = 0
+        self.write_raw(magic + struct.pack("<Bd", format_version, self.start))
+
+    def close(self):
+        """Flushes and closes the stream file. Calls are still passed on to the wrapped display afterwards."""
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def rotate(self):
+        """Moves the recording to path.1, shifting older files up, and starts a new one."""
+        self.file.close()
+        for n in range(self.backup_count - 1, 0, -1):
+            if os.path.exists("%s.%s" % (self.path, n)):
+                os.replace("%s.%s" % (self.path, n), "%s.%s" % (self.path, n + 1))
+        if self.backup_count > 0:
+            os.replace(self.path, "%s.1" % self.path)
+        self.open()
+
+    def write_raw(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def record(self, operation, arguments=b""):
+        """Writes a record to the stream."""
+        with self.lock:
+            if self.file is None:
+                return
+            now = time.time()
+            delta = max(0, int(round((now - self.last_time) * 1000000)))
+            self.last_time = now
+            self.write_raw(bytearray([operation]) + encode_varint(delta) + arguments)
+            self.records += 1
+            if now - self.last_flush >= self.flush_interval:
+                self.file.flush()
+                self.last_flush = now
+            if self.max_bytes is not None and self.size >= self.max_bytes:
+                self.rotate()
+
+    def forward(self, name, *args):
+        if self.display is not None:
+            return getattr(self.display, name)(*args)
+
+    def set_cursor(self, col, row):
+        self.record(op_set_cursor, bytearray([col & 0xFF, row & 0xFF]))
+        self.forward("set_cursor", col, row)
+
+    def message(self, text):
+        data = text.encode("latin-1", "replace")
+        self.record(op_message, encode_varint(len(data)) + data)
+        self.forward("message", text)
+
+    def create_char(self, location, pattern):
+        self.record(op_create_char, bytearray([location & 0x7]) + bytearray(pattern[i] & 0xFF for i in range(8)))
+        self.forward("create_char", location, pattern)
+
+    def create_chars(self, patterns):
+        data = bytearray([len(patterns)])
+        for location in sorted(patterns):
+            data += bytearray([location & 0x7]) + bytearray(patterns[location][i] & 0xFF for i in range(8))
+        self.record(op_create_chars, data)
+        if self.display is not None and not hasattr(self.display, "create_chars"):
+            for location in sorted(patterns):
+                self.display.create_char(location, patterns[location])
+        else:
+            self.forward("create_chars", patterns)
+
+    def clear(self):
+        self.record(op_clear)
+        self.forward("clear")
+
+    def home(self):
+        self.record(op_home)
+        self.forward("home")
+
+    def enable_display(self, enable):
+        self.record(op_enable_display, bytearray([1 if enable else 0]))
+        self.forward("enable_display", enable)
+
+    def set_backlight(self, backlight):
+        self.record(op_set_backlight, struct.pack("<f", backlight))
+        self.forward("set_backlight", backlight)
+
+    def set_color(self, red, green, blue):
+        self.record(op_set_color, struct.pack("<fff", red, green, blue))
+        self.forward("set_color", red, green, blue)
+
+    def shift(self, name):
+        self.record(shift_operations[name])
+        self.forward(name)
+
+    def __getattr__(self, name):
+        # Only called for attributes the recorder doesn't have itself, like the executor of the display.
+        if name == "display" or self.__dict__.get("display") is None:
+            raise AttributeError(name)
+        attribute = getattr(self.display, name)
+        if name in shift_operations:
+            # Shifting is only offered if the display can do it, and is recorded.
+            return lambda: self.shift(name)
+        return attribute
+
+
+class stream_reader(object):
+    """Reads the records of a stream file, one at a time, so recordings of any size can be read."""
+    def __init__(self, path):
+        self.path = path
+
+    def read(self, f, size):
+        data = f.read(size)
+        if len(data) < size:
+            raise EOFError
+        return bytearray(data)
+
+    def read_varint(self, f):
+        value = 0
+        shift = 0
+        while True:
+            byte = self.read(f, 1)[0]
+            value |= (byte & 0x7F) << shift
+            shift += 7
+            if byte < 0x80:
+                return value
+
+    def records(self):
+        """Yields (time, operation name, arguments) tuples, with the time in seconds since the epoch. A record that is
+        cut off, as at the end of a recording that was still being written, ends the stream."""
+        with open(self.path, "rb") as f:
+            header = f.read(len(magic) + 9)
+            if len(header) < len(magic) + 9 or header[:len(magic)] != magic:
+                raise ValueError("%s is not a display recording" % self.path)
+            version, now = struct.unpack("<Bd", header[len(magic):])
+            if version != format_version:
+                raise ValueError("%s is a display recording of unknown version %s" % (self.path, version))
+            while True:
+                try:
+                    operation = f.read(1)
+                    if not operation:
+                        return
+                    operation = bytearray(operation)[0]
+                    now += self.read_varint(f) / 1000000.0
+                    yield (now, operation_names.get(operation), self.read_arguments(f, operation))
+                except EOFError:
+                    return
+
+    def read_arguments(self, f, operation):
+        if operation == op_set_cursor:
+            return tuple(self.read(f, 2))
+        elif operation == op_message:
+            return (bytes(self.read(f, self.read_varint(f))).decode("latin-1"),)
+        elif operation == op_create_char:
+            data = self.read(f, 9)
+            return (data[0], [row for row in data[1:]])
+        elif operation == op_create_chars:
+            patterns = {}
+            for _ in range(self.read(f, 1)[0]):
+                data = self.read(f, 9)
+                patterns[data[0]] = [row for row in data[1:]]
+            return (patterns,)
+        elif operation in (op_clear, op_home, op_move_left, op_move_right):
+            return ()
+        elif operation == op_enable_display:
+            return (self.read(f, 1)[0] == 1,)
+        elif operation == op_set_backlight:
+            return struct.unpack("<f", bytes(self.read(f, 4)))
+        elif operation == op_set_color:
+            return struct.unpack("<fff", bytes(self.read(f, 12)))
+        raise ValueError("%s contains an unknown operation %s" % (self.path, operation))
+
+def replay(path, display=None, speed=1.0):
+    """Plays a recording back into a display. Speed 1.0 replays in real time, 2.0 twice as fast, and None as fast as
+    possible. Without a display, the calls are printed to stdout. Returns the number of calls replayed."""
+    replayed = 0
+    first = None
+    started = time.time()
+    for now, name, arguments in stream_reader(path).records():
+        if first is None:
+            first = now
+        if speed:
+            delay = (now - first) / speed - (time.time() - started)
+            if delay > 0:
+                time.sleep(delay)
+        if display is None:
+            print("%.6f %s %s" % (now - first, name, " ".join(repr(argument) for argument in arguments)))
+        elif name == "create_chars" and not hasattr(display, "create_chars"):
+            for location in sorted(arguments[0]):
+                display.create_char(location, arguments[0][location])
+        else:
+            getattr(display, name)(*arguments)
+        replayed += 1
+    return replayed
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python -m libLCDUI_recorder <recording>")
+        sys.exit(1)
+    replay(sys.argv[1], speed=None)
@@ -0,0 +1,123 @@
+#!/usr/bin/python
+"""A display that draws to a terminal, for running libLCDUI without hardware.
+
+terminal_display can be passed to libLCDUI.ui in place of an Adafruit_CharLCD object. The first frame draws the
+display with a border; after that only the cells that changed are written, using ANSI cursor addressing. Output is
+collected during a frame and written to the terminal at once when the UI flushes the display, so a frame costs a
+single write. Special characters are shown by the stdout symbol of their bitmap in the theme.
+
+Several panels can share a terminal by giving each its own position:
+
+    panels = [libLCDUI.ui(terminal_display(20, 4, top=1 + 7 * n), 20, 4) for n in range(4)]"""
+
+import sys
+
+import libLCDUI
+
+
+class terminal_display(object):
+    """Emulates a character LCD in a terminal. Top and left are the terminal row and column (counting from 1) of the
+    top left corner of the border. The theme is used to show the bitmaps in the special character register by their
+    stdout symbol; bitmaps that are not in the theme are shown as a question mark."""
+    def __init__(self, cols=20, lines=4, stream=None, top=1, left=1, theme=None):
+        self.cols = cols
+        self.lines = lines
+        self.stream = stream if stream is not None else sys.stdout
+        self.top = top
+        self.left = left
+        self.symbols = {}
+        self.set_theme(theme if theme is not None else libLCDUI.default_theme)
+        self.cgram = [None] * 8
+        self.ddram = [[" "] * cols for _ in range(lines)]
+        self.shown = None
+        self.enabled = True
+        self.col = 0
+        self.row = 0
+
+    def set_theme(self, theme):
+        """Sets the theme used to show special characters."""
+        theme = libLCDUI.compile_theme(theme)
+        self.symbols = dict(zip(theme.bitmaps, theme.fallbacks))
+
+    def set_cursor(self, col, row):
+        if row >= self.lines:
+            row = self.lines - 1
+        self.col = col
+        self.row = row
+
+    def message(self, text):
+        for char in text:
+            if char == "\n":
+                self.set_cursor(0, self.row + 1)
+            else:
+                if self.col < self.cols:
+                    self.ddram[self.row][self.col] = char
+                self.col += 1
+
+    def create_char(self, location, pattern):
+        self.cgram[location & 0x7] = bytes(bytearray(pattern[i] for i in range(8)))
+
+    def create_chars(self, patterns):
+        for location, pattern in patterns.items():
+            self.create_char(location, pattern)
+
+    def clear(self):
+        self.ddram = [[" "] * self.cols for _ in range(self.lines)]
+        self.home()
+
+    def home(self):
+        self.set_cursor(0, 0)
+
+    def enable_display(self, enable):
+        self.enabled = enable
+
+    def set_backlight(self, backlight):
+        pass
+
+    def set_color(self, red, green, blue):
+        pass
+
+    def visible_text(self, char):
+        """Returns what a cell holding char looks like in the terminal."""
+        if not self.enabled:
+            return " "
+        if ord(char) < 8:
+            return self.symbols.get(self.cgram[ord(char)], "?")
+        if ord(char) < 32 or ord(char) > 126:
+            return "?"
+        return char
+
+    def flush(self):
+        """Writes the changes since the last flush to the terminal, in one write. The UI calls this at the end of every
+        frame."""
+        screen = [[self.visible_text(char) for char in line] for line in self.ddram]
+        output = []
+        if self.shown is None:
+            border = "*" + "-" * self.cols + "*"
+            output.append("\x1b[%d;%dH%s" % (self.top, self.left, border))
+            for row, line in enumerate(screen):
+                output.append("\x1b[%d;%dH|%s|" % (self.top + row + 1, self.left, "".join(line)))
+            output.append("\x1b[%d;%dH%s" % (self.top + self.lines + 1, self.left, border))
+        else:
+            for row, line in enumerate(screen):
+                shown = self.shown[row]
+                col = 0
+                while col < self.cols:
+                    if line[col] == shown[col]:
+                        col += 1
+                        continue
+                    start = col
+                    while col < self.cols and line[col] != shown[col]:
+                        col += 1
+                    output.append("\x1b[%d;%dH%s" % (self.top + row + 1, self.left + start + 1,
+                                                     "".join(line[start:col])))
+        self.shown = screen
+        if output:
+            # Park the cursor below the display, so the terminal stays readable.
+            output.append("\x1b[%d;1H" % (self.top + self.lines + 2))
+            self.stream.write("".join(output))
+            self.stream.flush()
+
+    def invalidate(self):
+        """Draws the whole display again on the next flush, for example after something else wrote to the terminal."""
+        self.shown = None
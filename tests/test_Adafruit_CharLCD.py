@@ -0,0 +1,134 @@
+import pytest
+
+pytest.importorskip("Adafruit_GPIO")
+
+import Adafruit_CharLCD as LCD
+
+
+class hd44780(object):
+    """Model of an HD44780 that is fed the GPIOB port states of the char LCD plate. It starts in 8-bit mode, as after
+    power-on, and follows the DDRAM and CGRAM address counter of a display in 2-line mode."""
+    def __init__(self):
+        self.four_bit = False
+        self.nibble = None
+        self.enable = False
+        self.ddram = dict((address, " ") for address in list(range(0x00, 0x28)) + list(range(0x40, 0x68)))
+        self.cgram = [0] * 64
+        self.address = 0
+        self.in_cgram = False
+        self.commands = []
+
+    def feed(self, state):
+        enable = bool(state & LCD._PLATE_PORTB_EN)
+        if self.enable and not enable:
+            # Data is latched on the falling edge of enable.
+            nibble = sum(1 << n for n, bit in enumerate(LCD._PLATE_PORTB_DATA) if state & bit)
+            self.latch(nibble, bool(state & LCD._PLATE_PORTB_RS))
+        self.enable = enable
+
+    def latch(self, nibble, rs):
+        if not self.four_bit:
+            self.execute(nibble << 4, rs)
+        elif self.nibble is None:
+            self.nibble = nibble
+        else:
+            value = (self.nibble << 4) | nibble
+            self.nibble = None
+            self.execute(value, rs)
+
+    def execute(self, value, rs):
+        if rs:
+            if self.in_cgram:
+                self.cgram[self.address] = value
+                self.address = (self.address + 1) & 0x3F
+            else:
+                self.ddram[self.address] = chr(value)
+                self.address = {0x27: 0x40, 0x67: 0x00}.get(self.address, self.address + 1)
+            return
+        self.commands.append(value)
+        if value & LCD.LCD_SETDDRAMADDR:
+            self.address = value & 0x7F
+            assert self.address in self.ddram, "invalid DDRAM address 0x%02x" % self.address
+            self.in_cgram = False
+        elif value & LCD.LCD_SETCGRAMADDR:
+            self.address = value & 0x3F
+            self.in_cgram = True
+        elif value & LCD.LCD_FUNCTIONSET:
+            self.four_bit = not value & LCD.LCD_8BITMODE
+        elif value in (LCD.LCD_CLEARDISPLAY, LCD.LCD_RETURNHOME):
+            if value == LCD.LCD_CLEARDISPLAY:
+                for address in self.ddram:
+                    self.ddram[address] = " "
+            self.address = 0
+            self.in_cgram = False
+
+    def line(self, row, cols):
+        return "".join(self.ddram[LCD.LCD_ROW_OFFSETS[row] + col] for col in range(cols))
+
+
+def decode(transactions):
+    """Feeds the GPIOB states of the recorded writes to the port registers into a model display. With IOCON.BANK = 0 and
+    sequential operation disabled, the writes alternate between GPIOA and GPIOB."""
+    display = hd44780()
+    for busnum, address, operation, register, data in transactions:
+        if operation == "write" and register == LCD.MCP23017_GPIOA:
+            for state in data[1::2]:
+                display.feed(state)
+    return display
+
+
+def plate(cols=16, lines=2):
+    i2c = LCD.RecordingI2C()
+    lcd = LCD.Adafruit_CharLCDPlate(i2c=i2c, cols=cols, lines=lines, timing=LCD.HD44780_DATASHEET_TIMING)
+    return lcd, i2c
+
+
+def test_init_sequence_switches_to_4_bit_mode():
+    lcd, i2c = plate()
+    display = decode(i2c.transactions)
+    assert display.four_bit
+    assert display.commands[-1] == LCD.LCD_CLEARDISPLAY
+
+
+def test_messages_are_decoded_at_the_cursor():
+    lcd, i2c = plate()
+    lcd.message("Hello\nworld")
+    lcd.set_cursor(10, 0)
+    lcd.message("!")
+    display = decode(i2c.transactions)
+    assert display.line(0, 16) == "Hello     !     "
+    assert display.line(1, 16) == "world           "
+
+
+def test_create_chars_uploads_patterns_and_restores_the_cursor():
+    lcd, i2c = plate()
+    lcd.set_cursor(3, 1)
+    lcd.message("ab")
+    patterns = {1: [1, 2, 3, 4, 5, 6, 7, 8], 2: [31] * 8, 5: [0, 31] * 4}
+    lcd.create_chars(patterns)
+    lcd.message("cd")
+    display = decode(i2c.transactions)
+    for location, pattern in patterns.items():
+        assert display.cgram[location * 8:location * 8 + 8] == pattern
+    assert display.line(1, 16) == "   abcd         "
+
+
+def test_cursor_is_restored_after_a_full_row():
+    lcd, i2c = plate(20, 4)
+    lcd.set_cursor(0, 2)
+    lcd.message("x" * 20)
+    lcd.create_char(0, [31] * 8)
+    lcd.message("y")
+    display = decode(i2c.transactions)
+    # Row 2 ends at 0x27; the address counter then continues at row 1.
+    assert display.line(2, 20) == "x" * 20
+    assert display.line(1, 20) == "y" + " " * 19
+
+
+def test_batched_writes_fit_in_smbus_blocks():
+    lcd, i2c = plate()
+    i2c.reset()
+    lcd.message("A long line of text")
+    assert i2c.transactions
+    for busnum, address, operation, register, data in i2c.transactions:
+        assert len(data) <= LCD.I2C_BLOCK_SIZE
@@ -0,0 +1,202 @@
+import random
+
+import libLCDUI
+
+
+class fake_display(object):
+    """Character LCD with 40 characters of memory per row, and a cursor that doesn't wrap."""
+    def __init__(self, cols=20, lines=4):
+        self.cols = cols
+        self.ddram = [[" "] * 40 for _ in range(lines)]
+        self.cgram = {}
+        self.col = 0
+        self.row = 0
+
+    def set_cursor(self, col, row):
+        self.col = col
+        self.row = row
+
+    def message(self, text):
+        for char in text:
+            self.ddram[self.row][self.col % 40] = char
+            self.col += 1
+
+    def create_char(self, location, pattern):
+        self.cgram[location] = bytes(bytearray(pattern))
+
+    def clear(self):
+        self.ddram = [[" "] * 40 for _ in self.ddram]
+
+    def screen(self):
+        return ["".join(line[:self.cols]) for line in self.ddram]
+
+
+def test_plan_rewrites_short_gaps():
+    plan = libLCDUI.redraw_plan(cursor_cost=3)
+    plan.add_row(0, "abcdefgh", [(0, 2), (4, 6)])
+    assert plan.operations == [("cursor", 0, 0), ("message", "abcdef")]
+    assert plan.cells_changed == 4
+    assert plan.cost() == 3 + 6
+    assert plan.naive_cost() == 4 * (3 + 1)
+
+
+def test_plan_moves_cursor_over_long_gaps():
+    plan = libLCDUI.redraw_plan(cursor_cost=1)
+    plan.add_row(0, "abcdefghijkl", [(0, 2), (10, 12)])
+    assert plan.operations == [("cursor", 0, 0), ("message", "ab"), ("cursor", 10, 0), ("message", "kl")]
+
+
+def test_plan_moves_cursor_between_rows():
+    plan = libLCDUI.redraw_plan(cursor_cost=5)
+    plan.add_row(0, "abcd", [(2, 4)])
+    plan.add_row(1, "efgh", [(0, 2)])
+    assert plan.operations == [("cursor", 2, 0), ("message", "cd"), ("cursor", 0, 1), ("message", "ef")]
+
+
+def test_plan_reports_failed_rows():
+    plan = libLCDUI.redraw_plan()
+    plan.add_row(0, "abcd", [(0, 1)])
+    plan.add_row(2, "efgh", [(3, 4)])
+    display = fake_display()
+
+    def message(text):
+        if text == "h":
+            raise IOError("bus error")
+        fake_display.message(display, text)
+    display.message = message
+    errors = plan.apply(display)
+    assert [operation for operation, error in errors] == [("message", "h")]
+    assert plan.failed_rows(errors) == set([2])
+    assert display.screen()[0][0] == "a"
+
+    display = fake_display()
+    display.set_cursor = lambda col, row: 1 / 0
+    assert plan.failed_rows(plan.apply(display)) is None
+
+
+def bitmap(n):
+    return bytes(bytearray([n] * 8))
+
+
+def test_register_never_evicts_visible_bitmaps():
+    register = libLCDUI.character_register_manager(fake_display(), 8)
+    characters = [("C%d" % n, bitmap(n), str(n)) for n in range(9)]
+    register.plan_frame(characters)
+    assert [register.get_output("C%d" % n) for n in range(8)] == [chr(n) for n in range(8)]
+    # The ninth doesn't fit, and falls back to its ASCII representation.
+    assert register.get_output("C8") == "8"
+
+    # A new bitmap can't replace any of the visible ones either.
+    register.plan_frame(characters[:8] + [("NEW", bitmap(20), "n")])
+    assert [register.get_output("C%d" % n) for n in range(8)] == [chr(n) for n in range(8)]
+    assert register.get_output("NEW") == "n"
+
+
+def test_register_replaces_the_oldest_hidden_bitmap():
+    register = libLCDUI.character_register_manager(fake_display(), 2)
+    register.plan_frame([("A", bitmap(1), "a"), ("B", bitmap(2), "b")])
+    register.plan_frame([("B", bitmap(2), "b")])
+    changed = register.plan_frame([("B", bitmap(2), "b"), ("C", bitmap(3), "c")])
+    assert register.get_output("B") == "\x01"
+    assert register.get_output("C") == "\x00"
+    assert changed == set(["C"])
+
+
+def test_register_shares_slots_and_uploads_once():
+    display = fake_display()
+    register = libLCDUI.character_register_manager(display, 8)
+    register.plan_frame([("A", bitmap(1), "a"), ("SAME_AS_A", bitmap(1), "s")])
+    assert register.get_output("A") == register.get_output("SAME_AS_A")
+    assert register.flush_uploads() == 1
+    assert display.cgram == {0: bitmap(1)}
+    register.plan_frame([("A", bitmap(1), "a")])
+    assert register.flush_uploads() == 0
+
+
+def test_register_falls_back_to_a_fixed_character():
+    register = libLCDUI.character_register_manager(fake_display(), 1, fallback="#")
+    register.plan_frame([("A", bitmap(1), "a"), ("B", bitmap(2), "b")])
+    assert register.get_output("B") == "#"
+
+
+def full_recompose(widgets, width, height):
+    """Composes the whole screen of the widgets on a new UI."""
+    reference = libLCDUI.ui(None, width, height)
+    for widget in widgets:
+        row, col = widget.row, widget.col
+        reference.add_widget(widget, row, col)
+    reference.compose(dict((row, [(0, width)]) for row in range(height)))
+    return ["".join(chr(glyph) for glyph in reference.framebuffer.get_row(row)) for row in range(height)]
+
+
+def check_dirty_redraw(optimize_redraw, seed):
+    randomizer = random.Random(seed)
+    display = fake_display(20, 4)
+    ui = libLCDUI.ui(display, 20, 4)
+    ui.optimize_redraw = optimize_redraw
+    widgets = []
+    for n in range(6):
+        widget = libLCDUI.text(randomizer.randint(1, 12), randomizer.randint(1, 3), "w%d" % n)
+        ui.add_widget(widget, randomizer.randint(0, 4 - widget.height), randomizer.randint(0, 20 - widget.width))
+        widget.write("%d" % n * 30)
+        widgets.append(widget)
+    for step in range(200):
+        widget = randomizer.choice(widgets)
+        action = randomizer.randint(0, 3)
+        if action == 0:
+            widget.write("".join(randomizer.choice("abc ") for _ in range(randomizer.randint(0, 30))))
+        elif action == 1:
+            widget.row = randomizer.randint(0, 4 - widget.height)
+            widget.col = randomizer.randint(0, 20 - widget.width)
+        elif action == 2:
+            if widget.visible:
+                widget.hide()
+            else:
+                widget.show()
+        else:
+            ui.remove_widget(widget.name)
+            ui.add_widget(widget, widget.row, widget.col)
+        ui.redraw()
+        assert display.screen() == full_recompose(ui.widgets, 20, 4), "step %d" % step
+
+
+def test_dirty_redraw_matches_full_recompose():
+    for seed in range(5):
+        check_dirty_redraw(False, seed)
+
+
+def test_optimized_dirty_redraw_matches_full_recompose():
+    for seed in range(5):
+        check_dirty_redraw(True, seed)
+
+
+def test_failed_write_is_retried():
+    display = fake_display()
+    ui = libLCDUI.ui(display, 20, 4)
+    ui.optimize_redraw = True
+    widget = libLCDUI.text(10, 1, "t")
+    ui.add_widget(widget, 1, 0)
+    widget.write("hello")
+    ui.redraw()
+    message = display.message
+
+    def failing_message(text):
+        raise IOError("bus error")
+    display.message = failing_message
+    widget.write("world")
+    ui.redraw()
+    display.message = message
+    ui.redraw()
+    assert display.screen()[1].startswith("world")
+
+
+def test_progress_bar_clamps_values():
+    bar = libLCDUI.horizontal_progress_bar(8, 1, 0, 10)
+    bar.write(-5)
+    empty = bar.contents
+    bar.write(0)
+    assert bar.contents == empty
+    bar.write(15)
+    full = bar.contents
+    bar.write(10)
+    assert bar.contents == full